@@ -3,12 +3,18 @@
 
 import zipfile
 import pathlib
+import os
 import uuid
 import datetime
+import time
+from collections import deque
+from string import Formatter
+from xml.sax.saxutils import escape
 from OPF import Metadata, Mainfest, Spine, NavMap, ManifestItem, NavPoint
-from OPF import CoreMediaType
-from OPF import lineidentity as indent
-from EpubReader import getsource
+from OPF import CoreMediaType, Spool
+from OPF import writechunks
+from ZipWriter import ReuseWriter, CRCWriter, fingerprint
+from EpubReader import getsource, readbook, getdate
 
 _F_MIMETYPE = 'application/epub+zip'
 _F_CONTAINER_XML = '''\
@@ -46,6 +52,11 @@ _F_TOC_NCX = '''\
   </docTitle>
 {navmap}
 </ncx>'''
+# 可重现的生成方式下条目的时间,这是zip格式能够表示的最早时间
+_FIXED_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+_DEFAULT_TITLE = '未命名'  # 没有指定书名,也不能由文件名得到时使用的书名
 
 
 def guid(s='') -> str:
@@ -53,22 +64,69 @@ def guid(s='') -> str:
     return str(uuid.uuid3(uuid.NAMESPACE_OID, str(s)))
 
 
+def sourceepoch() -> int:
+    """环境变量SOURCE_DATE_EPOCH指定的生成时间(秒),没有指定时返回None"""
+    epoch = os.environ.get('SOURCE_DATE_EPOCH')
+    return int(epoch) if epoch else None
+
+
+def builddate(filename: str) -> str:
+    """可重现的生成方式下使用的dc:date
+    依次使用SOURCE_DATE_EPOCH指定的日期,已有的epub文件中记录的日期,当天的日期
+    """
+    epoch = sourceepoch()
+    if epoch is not None:
+        return time.strftime('%Y-%m-%d', time.gmtime(epoch))
+    if isinstance(filename, str) and os.path.isfile(filename):
+        date = getdate(filename)
+        if date:
+            return date
+    return str(datetime.date.today())
+
+
+def iterformat(fmt: str, **kwgs):
+    """逐段生成fmt.format(**kwgs)的结果
+    kwgs中的值如果是字符串之外的可迭代对象(比如_XML.iterxml()),
+    它将被逐段生成,而不是先连接为一个完整的字符串
+    """
+    for literal, field, _, _ in Formatter().parse(fmt):
+        yield literal
+        if field is not None:
+            value = kwgs[field]
+            if isinstance(value, str) or not hasattr(value, '__iter__'):
+                yield str(value)
+            else:
+                yield from value
+
+
 class EpubCreater(object):
     """epub文件生成器
     它完成对OPF.OPFObject的填充与epub文件的写入功能
+    所有的状态都属于实例,因此可以在同一个进程中先后或在多个线程中同时生成
+    多个epub文件,只要每个文件使用自己的EpubCreater实例
     """
-    __file = ''  # epub文件名
+    __file = ''  # epub文件名,或者一个可写的二进制流
     showlog = True  # 是否在文件生成过程中显示正在生成哪个文件
-    source = []  # 文档源,单个Doc以及可迭代Doc的对象
-    metadata = Metadata()
-    mainfest = Mainfest()
-    spine = Spine()
-    nav = NavMap()
+    workers = 1  # 压缩文档使用的线程数
+    compresslevel = -1  # deflate压缩级别(0-9),-1为zlib的默认级别
+    update = False  # 是否在已经存在的epub文件上追加文档
+    reproducible = False  # 是否以可重现的方式生成
+    fingerprint = None  # 生成的epub文件的指纹,见ZipWriter.fingerprint
+    memlimit = None  # 未决文档在内存中缓存的内容上限(字符数),None为不限制
+    pendingpeak = 0  # 未决文档在内存中缓存的内容曾经达到的最大值(字符数)
+    sourcemeta = None  # 文档源的参数,文档源迭代完毕后才加入metadata的source组
+    incomplete = ()  # 写入时仍未完成的文档的(name, title)列表
 
     def __init__(self, **args):
         """可以通过参数来设置必要的信息以及触发文件生成动作以简化初始化工作
-        可用的参数:file(self.__file),showlog
+        可用的参数:file(self.__file),showlog,workers,compresslevel,update,
+            reproducible,memlimit,sourcemeta
         """
+        self.source = []  # 文档源,单个Doc以及可迭代Doc的对象
+        self.metadata = Metadata()
+        self.mainfest = Mainfest()
+        self.spine = Spine(self.mainfest)
+        self.nav = NavMap()
         for k, v in args.items():
             if hasattr(self, k):
                 self.__setattr__(k, v)
@@ -82,34 +140,50 @@ class EpubCreater(object):
         if exc_type is None:
             self.write()
 
-    def __getcontentstr(self):
-        """生成OPF文件content.opf的内容"""
-        metadata = indent(self.metadata.xml)
-        manifest = indent(self.mainfest.xml)
-        spine = indent(self.spine.xml)
-        return _F_CONTENT_OPF.format(metadata=metadata,
-                                     manifest=manifest,
-                                     spine=spine)
-
-    def __gettocstr(self):
-        """生成文件toc.ncx的内容"""
-        return _F_TOC_NCX.format(identifier=self.metadata.identifier,
-                                 depth=self.nav.depth,
-                                 title=self.metadata.title,
-                                 navmap=indent(self.nav.xml))
+    def __itercontent(self):
+        """逐段生成OPF文件content.opf的内容"""
+        return iterformat(_F_CONTENT_OPF,
+                          metadata=self.metadata.iterxml(1),
+                          manifest=self.mainfest.iterxml(1),
+                          spine=self.spine.iterxml(1))
+
+    def __itertoc(self):
+        """逐段生成文件toc.ncx的内容"""
+        return iterformat(_F_TOC_NCX,
+                          identifier=self.metadata.identifier,
+                          depth=self.nav.depth,
+                          title=self.metadata.title,
+                          navmap=self.nav.iterxml(1))
 
     @property
     def file(self):
         return self.__file
 
     @file.setter
-    def file(self, file: str):
-        file = self.__forceext(file, 'epub')
+    def file(self, file):
+        """file: epub文件名,或者一个可写的二进制流(文件,管道,socket...)
+        流可以是不能seek的,epub文件将边生成边写入到流中
+        """
+        if isinstance(file, str):
+            file = self.__forceext(file, 'epub')
         self.__file = file
 
+    @property
+    def isstream(self) -> bool:
+        """是否写入到一个流而不是一个文件名"""
+        return not isinstance(self.__file, str)
+
     @property
     def stem(self):
-        return pathlib.PureWindowsPath(self.__file).stem
+        """文件名的主干部分,写入到流时使用流的name属性(如果有的话)
+        流的name不是文件名(比如sys.stdout的'<stdout>',或者一个文件描述符)时为''
+        """
+        name = self.__file
+        if self.isstream:
+            name = getattr(name, 'name', '')
+            if not isinstance(name, str) or name.startswith('<'):
+                name = ''
+        return pathlib.PureWindowsPath(name).stem
 
     @staticmethod
     def __forceext(file: str, ext: str = 'epub') -> str:
@@ -120,49 +194,213 @@ class EpubCreater(object):
 
     def addmetagroup(self, tag, data):
         """在metadata中添加一组meta
-        这组meta元素name属性的格式为"{tag}:{key}",值为str(data[key])
+        这组meta元素name属性的格式为"{tag}:{key}",值为str(data[key]),
+        值作为xml属性写入,其中的&<>"被转义(比如iter_page的hrefre)
         可以通过这种方式保存epub文件生成使用的迭代器的相关信息,以供之后重做
         """
         for key, val in data.items():
             self.metadata.append('{}:{}'.format(tag, key),
-                                 str(data[key]))
+                                 escape(str(data[key]), {'"': '&quot;'}))
+
+    def __loadbook(self, z: zipfile.ZipFile) -> set:
+        """以已有的epub文件z中的OPF结构替换当前的结构,返回其中的文档名
+        如果当前没有指定metadata,则沿用z中的metadata
+        """
+        metadata, self.mainfest, self.spine, self.nav = readbook(z)
+        if len(self.metadata) == 0:
+            self.metadata = metadata
+        return {e.href for e in self.mainfest if e.id != 'ncx'}
+
+    def __adddoc(self, doc, replaceable: set):
+        """将doc加入到mainfest/spine/nav中
+        replaceable: 可以被替换的已有文档名,替换只更新它在导航中的标题,
+            它在mainfest/spine/nav中的位置保持不变
+        """
+        if doc.name in replaceable:
+            replaceable.discard(doc.name)
+            node = self.nav.lookup(doc.name)
+            if node is not None:
+                node.label = doc.title
+            return
+        m_item = ManifestItem(doc.name, CoreMediaType.xhtml)
+        self.mainfest.append(m_item)
+        self.spine.append(doc.name)
+        parent = self.nav.lookup(doc.parentsrc)
+        if parent is None:
+            parent = self.nav
+        parent.append(NavPoint(doc.title, doc.name))
+
+    def __datetime(self):
+        """条目的时间,可重现的生成方式下它是固定的,否则为None(写入时的时间)"""
+        if not self.reproducible:
+            return None
+        epoch = sourceepoch()
+        if epoch is None:
+            return _FIXED_DATE_TIME
+        return max(time.gmtime(epoch)[:6], _FIXED_DATE_TIME)
 
     def write(self):
         """写入epub文件
         如果有一些文件是未决的(它们先提交了doc,然后才完成内容的构建),它们不能在
-        提交doc时就写入,需要建立一个列表记录这些未决doc,在适当的时候进行写入。
-        简单的做法是在迭代完毕后去写入
+        提交doc时就写入,需要建立一个队列记录这些未决doc,排在队首的doc一旦完成就
+        写入,文档源迭代完毕后写入剩下的doc.
+        memlimit不为None时,未决doc附加到一个暂存区(OPF.Spool),它们在内存中缓存的
+            内容总量不超过memlimit,超出的部分暂存到临时文件中.
+            写入完成后,pendingpeak为未决doc在内存中缓存的内容曾经达到的最大值
+        workers大于1时,文档在一组线程中压缩,但仍按提交的顺序写入
+        mimetype作为第一个条目以存储方式写入,这是epub规范的要求
+        update为True且epub文件已经存在时,文档源只需要给出新的文档:
+            已有的文档原样复制(不解压也不重新压缩),只有新文档需要压缩,
+            content.opf与toc.ncx在已有的结构上添加新文档后重新生成.
+            与已有文档同名的文档将替换它.
+        reproducible为True时,条目使用固定的时间,相同的内容总是得到相同的文件.
+            如果epub文件已经存在,生成过程中的每个条目都与它比较,在出现第一个
+            不同的条目之前什么也不写入;内容完全相同时原有的文件保持不变.
+        文档带有archived属性(大小, CRC)时(见Iterators.ArchivedDoc),如果已有的
+            epub文件中同名的条目与它一致,这个条目被原样复制,文档的内容不会被读取
+        已经存在的epub文件需要改变时,新文件先写入到一个临时文件中,完成后才替换它
+        file是一个流时,每个条目写入后都会刷新这个流,使已经生成的内容尽快到达对方,
+            流不会被关闭,update与reproducible只对文件名有效
+        sourcemeta在文档源迭代完毕后才加入metadata的source组,
+            因此文档源可以在迭代过程中更新它(比如iter_txt的续读标记)
+        文档源迭代完毕时仍未完成的doc(比如下载失败的章节,见Iterators.faileddoc)
+            照样写入,它们的(name, title)记录在incomplete中,showlog时列出它们
+        写入完成后,fingerprint为epub文件的指纹
         """
-        print('Create epub file:', self.__file)
-        with zipfile.ZipFile(self.__file, 'w') as z:
-            def wt(name, data):
-                if self.showlog:
-                    print('file "{}" to zip...'.format(name))
-                z.writestr(name, data, zipfile.ZIP_DEFLATED)
-            for source in self.source:
-                uncompleted = []
-                for doc in source:
-                    # doc有属性:name,title,html,parentsrc,complete
-                    if doc.complete:
-                        wt('OEBPS/' + doc.name, doc.html)
+        if self.showlog:
+            print('Create epub file:', self.__file)
+        old = None
+        replaceable = set()
+        target = self.__file
+        if not self.isstream and os.path.isfile(self.__file) and (
+                self.update or self.reproducible or
+                zipfile.is_zipfile(self.__file)):
+            old = zipfile.ZipFile(self.__file, 'r')
+            if self.update:
+                replaceable = self.__loadbook(old)
+            target = self.__file + '.tmp'
+        date_time = self.__datetime()
+        written = set()
+        incomplete = []
+        spool = None
+        if self.memlimit is not None:
+            spool = Spool(self.memlimit)
+        try:
+            with ReuseWriter(lambda: zipfile.ZipFile(target, 'w'),
+                             old if self.reproducible else None,
+                             self.workers, self.compresslevel,
+                             date_time=date_time,
+                             autoflush=self.isstream) as zw:
+                def wt(name, data):
+                    if self.showlog:
+                        print('file "{}" to zip...'.format(name))
+                    zw.write(name, data)
+                    written.add(name)
+
+                def wtstream(name, iterchunks):
+                    """将逐段生成的内容直接写入zip,不在内存中组装完整的内容
+                    iterchunks: 生成内容的函数,与参照比较时它会被调用两次
+                    """
+                    if zw.matching:
+                        crc = CRCWriter()
+                        writechunks(crc, iterchunks())
+                        if zw.reuse(name, crc.size, crc.CRC):
+                            return
+                    if self.showlog:
+                        print('file "{}" to zip...'.format(name))
+                    with zw.open(name) as fp:
+                        writechunks(fp, iterchunks())
+
+                def wtdoc(doc):
+                    name = 'OEBPS/' + doc.name
+                    zinfo = archived(name, getattr(doc, 'archived', None))
+                    if zinfo is None:
+                        wt(name, doc.encoded)
                     else:
-                        uncompleted.append(doc)
-                    m_item = ManifestItem(doc.name, CoreMediaType.xhtml)
-                    self.mainfest.append(m_item)
-                    self.spine.append(doc.name)
-                    try:
-                        path = tuple(self.nav.getpath(doc.parentsrc))
-                    except (Exception,):
-                        path = ()
-                    self.nav.append(NavPoint(doc.title, doc.name), *path)
-                for doc in uncompleted:
-                    if not doc.complete:
-                        pass  # 这是一个未完成的文档,还是写了吧
-                    wt('OEBPS/' + doc.name, doc.html)
-            wt('mimetype', _F_MIMETYPE)
-            wt('META-INF/container.xml', _F_CONTAINER_XML)
-            wt('OEBPS/content.opf', self.__getcontentstr())
-            wt('OEBPS/toc.ncx', self.__gettocstr())
+                        if self.showlog:
+                            print('file "{}" copied...'.format(name))
+                        zw.copy(old, zinfo)
+                        written.add(name)
+                    doc.unspool()
+
+                def wtpending(doc):
+                    """写入未决doc,它的标题可能在完成时才确定(比如重新下载
+                    成功的章节),导航中的标题随之更新
+                    """
+                    node = self.nav.lookup(doc.name)
+                    if node is not None:
+                        node.label = doc.title
+                    wtdoc(doc)
+
+                def archived(name, sizecrc):
+                    """已有的epub中与sizecrc一致的条目,没有时为None"""
+                    if sizecrc is None or old is None or \
+                            name not in old.NameToInfo:
+                        return None
+                    zinfo = old.getinfo(name)
+                    if (zinfo.file_size, zinfo.CRC) != tuple(sizecrc):
+                        return None
+                    return zinfo
+
+                wt('mimetype', _F_MIMETYPE)
+                wt('META-INF/container.xml', _F_CONTAINER_XML)
+                for source in self.source:
+                    uncompleted = deque()
+                    for doc in source:
+                        # doc有属性:name,title,html,parentsrc,complete
+                        while uncompleted and uncompleted[0].complete:
+                            wtpending(uncompleted.popleft())
+                        if doc.complete:
+                            wtdoc(doc)
+                        else:
+                            if spool is not None:
+                                doc.spoolto(spool)
+                            uncompleted.append(doc)
+                        self.__adddoc(doc, replaceable)
+                    while uncompleted:
+                        doc = uncompleted.popleft()
+                        if not doc.complete:
+                            # 这是一个未完成的文档,还是写了吧
+                            incomplete.append((doc.name, doc.title))
+                        wtpending(doc)
+                if self.sourcemeta:
+                    self.addmetagroup('source', self.sourcemeta)
+                if old is not None and self.update:
+                    for zinfo in old.infolist():
+                        if zinfo.filename in written or zinfo.filename in (
+                                'OEBPS/content.opf', 'OEBPS/toc.ncx'):
+                            continue
+                        if self.showlog:
+                            print('file "{}" copied...'.format(
+                                zinfo.filename))
+                        zw.copy(old, zinfo)
+                wtstream('OEBPS/content.opf', self.__itercontent)
+                wtstream('OEBPS/toc.ncx', self.__itertoc)
+            self.fingerprint = fingerprint(zw.z if zw.changed else old)
+            self.incomplete = incomplete
+        except BaseException:
+            if old is not None and os.path.isfile(target):
+                os.remove(target)
+            raise
+        finally:
+            if old is not None:
+                old.close()
+            if spool is not None:
+                spool.close()
+                self.pendingpeak = spool.peak
+                if self.showlog:
+                    print('pending docs: peak {} chars in memory, '
+                          '{} chars spooled'.format(spool.peak,
+                                                    spool.spooled))
+        if old is not None:
+            if zw.changed:
+                os.replace(target, self.__file)
+            elif self.showlog:
+                print('epub file unchanged:', self.__file)
+        if self.showlog and incomplete:
+            print('{} incomplete docs:'.format(len(incomplete)))
+            for name, title in incomplete:
+                print('    {} {}'.format(name, title))
 
 
 def getgenerator(_generator: str, **kwgs):
@@ -186,36 +424,80 @@ def getgenerator(_generator: str, **kwgs):
     return generator(**kwgs)
 
 
-def createepub(filename, source, showlog=True, meta=None):
+def createepub(filename, source, showlog=True, meta=None,
+               workers=1, compresslevel=-1, update=False, reproducible=False,
+               title=None, memlimit=None, incomplete=None):
     """简化的调用方式
-    filename: 要生成的epub文件,带扩展名,绝对路径或相对路径
+    filename: 要生成的epub文件,带扩展名,绝对路径或相对路径,
+        也可以是一个可写的二进制流,包括不能seek的管道/socket/HTTP响应,
+        epub文件将边生成边写入到流中
     source: 文档源迭代器实例
     showlog: 是否在生成过程中显示日志
     meta: 文档迭代器的初始化参数,这是一个dict,
         它的值应当都是字符类型或可以字符化的类型如数值
-        它们的顺序有时很重要
+        它们的顺序有时很重要.它在source迭代完毕后才记录到epub中,
+        因此source可以在迭代过程中更新它
+    workers: 压缩文档使用的线程数
+    compresslevel: deflate压缩级别(0-9),-1为zlib的默认级别
+    update: 如果filename已经存在,则只向其中追加source中的文档,
+        已有的文档原样保留,content.opf与toc.ncx重新生成
+    reproducible: 以可重现的方式生成,相同的内容总是得到相同的文件,
+        内容没有变化时已有的filename保持不变.
+        dc:date依次取SOURCE_DATE_EPOCH,已有文件中的日期,当天的日期
+    title: 书名,默认为filename的文件名部分,
+        流的name不是文件名(比如sys.stdout.buffer)时为_DEFAULT_TITLE
+    memlimit: 未决文档(比如iter_dir中每个文件的目录文档)在内存中缓存的内容上限
+        (字符数),超出的部分暂存到临时文件中.None为不限制
+    incomplete: 一个list,给出时写入时仍未完成的文档(比如下载失败的章节)的
+        (name, title)追加到其中,见EpubCreater.incomplete
+    返回epub文件的指纹
     """
-    stname = pathlib.PureWindowsPath(filename).stem
-    with EpubCreater(file=filename, showlog=showlog) as f:
-        f.metadata.append('title', stname)
+    with EpubCreater(file=filename, showlog=showlog, workers=workers,
+                     compresslevel=compresslevel, update=update,
+                     reproducible=reproducible, memlimit=memlimit) as f:
+        stname = title or f.stem or _DEFAULT_TITLE
+        f.metadata.append('title', escape(stname))
         f.metadata.append('identifier',
-                          'urn:uuid:' + guid(stname),
+                          escape('urn:uuid:' + guid(stname)),
                           id='BookId', opf_x3ascheme='UUID')
         f.metadata.append('language', '中文')
-        f.metadata.append('date', str(datetime.date.today()))
-        if meta:
-            f.addmetagroup('source', meta)
+        if reproducible:
+            f.metadata.append('date', builddate(filename))
+        else:
+            f.metadata.append('date', str(datetime.date.today()))
+        f.sourcemeta = meta
         f.source.append(source)
+    if incomplete is not None:
+        incomplete.extend(f.incomplete)
+    return f.fingerprint
 
 
-def recreate(epub_file: str, showlog=True):
-    """重新生成一个epub文件"""
+def recreate(epub_file: str, showlog=True, reproducible=False,
+             incomplete=None):
+    """重新生成一个epub文件
+    reproducible: 见createepub,来源数据没有变化时epub文件保持不变
+    incomplete: 见createepub
+    生成器的参数中记录了续读标记(source:mark,见Iterators.iter_txt/iter_page)时,
+        生成器以state参数验证并更新它:标记有效时只追加新的章节(update方式),
+        否则完全重新生成
+    返回epub文件的指纹
+    """
     kwgs = getsource(epub_file)
     if kwgs:
-        createepub(filename=epub_file,
-                   source=getgenerator(**kwgs),
-                   showlog=showlog,
-                   meta=kwgs)
+        meta = dict(kwgs)
+        update = False
+        if 'mark' in kwgs:
+            source = getgenerator(state=meta, **kwgs)
+            update = bool(meta['mark'])
+        else:
+            source = getgenerator(**kwgs)
+        return createepub(filename=epub_file,
+                          source=source,
+                          showlog=showlog,
+                          meta=meta,
+                          update=update,
+                          reproducible=reproducible,
+                          incomplete=incomplete)
 
 
 if __name__ == '__main__':
@@ -2,6 +2,18 @@
 """读取epub文件到一个对象(EpubObject类型)"""
 import re
 import zipfile
+from xml.sax.saxutils import unescape
+from OPF import Metadata, Mainfest, ManifestItem, Spine
+from OPF import NavMap, NavPoint
+
+_re_attr = re.compile(r'([^\s=]+)="([^"]*)"')
+_re_metaitem = re.compile(r'^( *)<(dc:\w+|meta)((?: [^\s=]+="[^"]*")*)'
+                          r'(?: />|>(.*?)</\2>)', re.M | re.S)
+_re_maniitem = re.compile(r'<item((?: [^\s=]+="[^"]*")*) />')
+_re_spineitem = re.compile(r'<itemref idref="([^"]*)" linear="([^"]*)"')
+_re_navtoken = re.compile(r'^( *)<navPoint[ >]|^( *)<text>(.*?)</text>|'
+                          r'<content src="([^"]*)" />|</navPoint>',
+                          re.M | re.S)
 
 
 def _get_iterinfo(metas: list) -> dict:
@@ -12,6 +24,7 @@ def _get_iterinfo(metas: list) -> dict:
     re_source = re.compile('<meta name="source:(.+?)" content="(.*?)"')
     for item in metas:
         for k, v in re_source.findall(item):
+            v = unescape(v, {'&quot;': '"'})
             if v in ['True', 'False']:
                 iterinfo[k] = v == 'True'
             elif v.isdigit():
@@ -27,7 +40,8 @@ def _get_metadata(contentdata: str) -> list:
     """分析来自文件content.opf的内容,从中得到全部的metadata数据"""
     metas = []
     contentdata = contentdata.replace('\r\n', '')
-    s = re.compile(r'<metadata.*?>(.*?)</metadata>').findall(contentdata)[0]
+    s = re.compile(r'<metadata.*?>(.*?)</metadata>',
+                   re.S).findall(contentdata)[0]
     for e in re.compile('(<.+?>.+?</.+?>|<.+?/>)').findall(s):
         metas.append(e)
     return metas
@@ -42,6 +56,71 @@ def _readstrfile(z: zipfile.ZipFile, filename: str) -> str:
     return data
 
 
+def _attrname(name: str) -> str:
+    """将xml属性名编码为_XML使用的属性名(与OPF.displayedname相反)"""
+    return name.replace('_x', '__x78').replace(':', '_x3a').replace('-', '_x2d')
+
+
+def _attrs(s: str) -> dict:
+    """分析一段xml属性描述,得到{_XML属性名: 值}"""
+    return {_attrname(k): v for k, v in _re_attr.findall(s)}
+
+
+def _dedent(s: str, prefix: str) -> str:
+    """去掉多行的值在输出xml时在后续行前添加的缩进"""
+    return s.replace('\n' + prefix, '\n')
+
+
+def _get_block(data: str, tag: str) -> str:
+    """得到data中<tag ...>与</tag>之间的内容"""
+    block = re.compile(r'<{0}\b[^>]*>(.*?)</{0}>'.format(tag), re.S)
+    found = block.search(data)
+    return found.group(1) if found else ''
+
+
+def readbook(z: zipfile.ZipFile):
+    """读出一个由EpubCreater生成的epub中的OPF结构
+    返回(Metadata, Mainfest, Spine, NavMap),它们的xml与原来的完全一致,
+    可以在它们的基础上添加新的文档,再重新生成content.opf与toc.ncx
+    """
+    content = _readstrfile(z, 'OEBPS/content.opf')
+    metadata = Metadata()
+    for prefix, tag, attrs, text in _re_metaitem.findall(
+            _get_block(content, 'metadata')):
+        attrs = _attrs(attrs)
+        if tag == 'meta':
+            metadata.append(attrs.get('name'),
+                            _dedent(attrs.get('content', ''), prefix))
+        else:
+            metadata.append(tag[3:], _dedent(text, prefix), **attrs)
+    mainfest = Mainfest()
+    for attrs in _re_maniitem.findall(_get_block(content, 'manifest')):
+        attrs = _attrs(attrs)
+        href = attrs.pop('href')
+        media_type = attrs.pop('media_x2dtype', None)
+        mainfest.append(ManifestItem(href, media_type, **attrs))
+    spine = Spine(mainfest)
+    for idref, linear in _re_spineitem.findall(_get_block(content, 'spine')):
+        spine.append(mainfest.lookupid(idref).href)
+        spine[-1].linear = linear
+    nav = NavMap()
+    stack = [nav]
+    label = ''
+    navmap = _get_block(_readstrfile(z, 'OEBPS/toc.ncx'), 'navMap')
+    for found in _re_navtoken.finditer(navmap):
+        token = found.group(0).lstrip()
+        if token.startswith('<navPoint'):
+            stack.append(None)
+        elif token.startswith('<text>'):
+            label = _dedent(found.group(3), found.group(2))
+        elif token.startswith('<content'):
+            stack[-1] = NavPoint(label, found.group(4))
+            stack[-2].append(stack[-1])
+        else:
+            stack.pop()
+    return metadata, mainfest, spine, nav
+
+
 def getsource(epub_file: str) -> dict:
     """获取epub包中content.opf文件记录的章节源信息
     它们在metadata节中以meta元素存储,name以source:xxx构成
@@ -52,3 +131,11 @@ def getsource(epub_file: str) -> dict:
     if args is None or len(args.keys()) == 0:
         args = None
     return args
+
+
+def getdate(epub_file: str) -> str:
+    """获取epub包中content.opf文件记录的dc:date,没有记录时返回None"""
+    with zipfile.ZipFile(epub_file, 'r') as z:
+        found = re.search(r'<dc:date\b[^>]*>(.*?)</dc:date>',
+                          _readstrfile(z, 'OEBPS/content.opf'), re.S)
+    return found.group(1) if found else None
@@ -0,0 +1,684 @@
+# -*- coding: utf-8 -*-
+"""Iterators中的爬虫共用的页面下载器
+它为每个主机保持一组持久连接(keep-alive),请求压缩传输(gzip/deflate),
+并根据响应头与页面中的<meta>识别页面的字符集
+"""
+
+import re
+import os
+import base64
+import time
+import random
+import zlib
+import codecs
+import hashlib
+import sqlite3
+import threading
+import http.client
+from email.message import Message
+from email.utils import parsedate_to_datetime
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit, urlunsplit, urljoin, unquote
+from urllib.request import getproxies, proxy_bypass
+
+_re_charset = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.I)
+_REDIRECTS = (301, 302, 303, 307, 308)
+_MAX_REDIRECTS = 5
+_THROTTLED = (429, 503)  # 服务器要求降低请求频率的状态码
+_TRANSIENT = (429, 500, 502, 503, 504)  # 稍后重试可能成功的状态码
+
+
+def decodebody(body: bytes, encoding: str) -> bytes:
+    """按响应头Content-Encoding解压响应的内容"""
+    encoding = (encoding or '').strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            return zlib.decompress(body, -zlib.MAX_WBITS)  # 没有zlib头的deflate
+    return body
+
+
+def pagecharset(headers, body: bytes, default: str = 'utf-8') -> str:
+    """页面的字符集:依次取响应头Content-Type中的charset,页面开始部分
+    <meta>中的charset,最后才是default.不认识的字符集被忽略
+    """
+    candidates = [headers.get_content_charset() if headers else None]
+    found = _re_charset.search(body[:4096])
+    if found:
+        candidates.append(found.group(1).decode('ascii'))
+    for charset in candidates:
+        if charset:
+            try:
+                return codecs.lookup(charset).name
+            except LookupError:
+                pass
+    return default
+
+
+class Response(object):
+    """一个已经读完的响应
+    url: 最终的地址(跟随重定向之后)
+    status/headers: 状态码与响应头
+    body: 解压后的内容
+    """
+    __slots__ = ('url', 'status', 'headers', 'body')
+
+    def __init__(self, url: str, status: int, headers, body: bytes):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def text(self, encode: str = 'utf-8') -> str:
+        """以pagecharset()识别的字符集解码的内容,encode为识别不出时使用的编码"""
+        return self.body.decode(pagecharset(self.headers, self.body, encode))
+
+
+class HttpCache(object):
+    """页面的磁盘缓存
+    内容以它的sha1为名保存在path中(相同的内容只保存一份,以zlib压缩),
+    每个url的ETag/Last-Modified等记录在path/index.sqlite中.
+    缓存的页面再次被请求时:
+        offline为True时直接使用缓存,不访问网络,缓存中没有时引发URLError;
+        页面已经被视为不再改变时直接使用缓存;
+        否则以If-None-Match/If-Modified-Since重新验证,
+        服务器回答304(没有改变)时使用缓存,不再传输内容
+    immutable: 内容连续多少天没有改变之后就视为不再改变,None为总是重新验证.
+        也可以是[(url的正则表达式, 天数), ...],使用第一个匹配的,
+        都不匹配时总是重新验证,比如章节页一周后不再验证,目录页总是验证:
+        [(r'/\d+\.html$', 7)]
+    maxsize: 缓存的内容的总字节数上限(压缩后),超出时删除最久没有使用的页面
+    """
+
+    def __init__(self, path: str, immutable=None, maxsize: int = 1 << 30,
+                 offline: bool = False):
+        self.path = os.path.expanduser(path)
+        self.maxsize = maxsize
+        self.offline = offline
+        if immutable is None or isinstance(immutable, (int, float)):
+            immutable = [('', immutable)]
+        self.immutable = [(re.compile(pattern), days)
+                          for pattern, days in immutable]
+        os.makedirs(self.path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(self.path, 'index.sqlite'),
+                                   check_same_thread=False)
+        self._db.executescript('''
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY, digest TEXT, ctype TEXT,
+                etag TEXT, lastmod TEXT,
+                changed REAL, used REAL);
+            CREATE INDEX IF NOT EXISTS pages_used ON pages (used);
+            CREATE INDEX IF NOT EXISTS pages_digest ON pages (digest);
+            CREATE TABLE IF NOT EXISTS blobs (
+                digest TEXT PRIMARY KEY, size INTEGER);
+        ''')
+        self.size = self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+        with self._lock:
+            self._evict()
+            self._db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _blobfile(self, digest: str) -> str:
+        return os.path.join(self.path, digest[:2], digest)
+
+    def lookup(self, url: str):
+        """url的缓存记录(url, digest, ctype, etag, lastmod, changed),没有时为None"""
+        with self._lock:
+            return self._db.execute(
+                'SELECT url, digest, ctype, etag, lastmod, changed '
+                'FROM pages WHERE url = ?', (url,)).fetchone()
+
+    def isimmutable(self, entry) -> bool:
+        """缓存的页面是否已经被视为不再改变"""
+        for pattern, days in self.immutable:
+            if pattern.search(entry[0]):
+                return days is not None and \
+                    time.time() - entry[5] >= days * 86400
+        return False
+
+    def validators(self, entry) -> dict:
+        """重新验证entry使用的请求头"""
+        headers = {}
+        if entry[3]:
+            headers['If-None-Match'] = entry[3]
+        if entry[4]:
+            headers['If-Modified-Since'] = entry[4]
+        return headers
+
+    def response(self, entry) -> Response:
+        """由缓存的内容建立响应,同时记录这次使用
+        内容已经不在缓存中(比如被删除了)时删除这个记录,返回None
+        """
+        try:
+            with open(self._blobfile(entry[1]), 'rb') as f:
+                body = zlib.decompress(f.read())
+        except (OSError, zlib.error):
+            with self._lock:
+                self._db.execute('DELETE FROM pages WHERE url = ?',
+                                 (entry[0],))
+                self._db.execute('DELETE FROM blobs WHERE digest = ?',
+                                 (entry[1],))
+                self.size = self._db.execute(
+                    'SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+                self._db.commit()
+            return None
+        headers = Message()
+        if entry[2]:
+            headers['Content-Type'] = entry[2]
+        with self._lock:
+            self._db.execute('UPDATE pages SET used = ? WHERE url = ?',
+                             (time.time(), entry[0]))
+            self._db.commit()
+        return Response(entry[0], 200, headers, body)
+
+    def store(self, url: str, headers, body: bytes):
+        """缓存一个(解压后的)页面,内容改变了时才更新它的改变时间"""
+        digest = hashlib.sha1(body).hexdigest()
+        blobfile = self._blobfile(digest)
+        now = time.time()
+        with self._lock:
+            old = self._db.execute('SELECT digest, changed FROM pages '
+                                   'WHERE url = ?', (url,)).fetchone()
+            changed = old[1] if old is not None and old[0] == digest else now
+            if not self._db.execute('SELECT 1 FROM blobs WHERE digest = ?',
+                                    (digest,)).fetchone():
+                data = zlib.compress(body)
+                os.makedirs(os.path.dirname(blobfile), exist_ok=True)
+                with open(blobfile + '.tmp', 'wb') as f:
+                    f.write(data)
+                os.replace(blobfile + '.tmp', blobfile)
+                self._db.execute('INSERT INTO blobs VALUES (?, ?)',
+                                 (digest, len(data)))
+                self.size += len(data)
+            self._db.execute(
+                'INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (url, digest, headers.get('Content-Type'),
+                 headers.get('ETag'), headers.get('Last-Modified'),
+                 changed, now))
+            if old is not None and old[0] != digest:
+                self._dropunused([old[0]])
+            self._evict()
+            self._db.commit()
+
+    def _dropunused(self, digests):
+        """删除不再被任何页面使用的内容"""
+        for digest in digests:
+            if self._db.execute('SELECT 1 FROM pages WHERE digest = ?',
+                                (digest,)).fetchone():
+                continue
+            row = self._db.execute('SELECT size FROM blobs WHERE digest = ?',
+                                   (digest,)).fetchone()
+            if row is None:
+                continue
+            self._db.execute('DELETE FROM blobs WHERE digest = ?', (digest,))
+            self.size -= row[0]
+            try:
+                os.remove(self._blobfile(digest))
+            except OSError:
+                pass
+
+    def _evict(self):
+        """内容总量超过maxsize时,按最久没有使用的顺序删除页面"""
+        while self.size > self.maxsize:
+            rows = self._db.execute('SELECT url, digest FROM pages '
+                                    'ORDER BY used LIMIT 100').fetchall()
+            if not rows:
+                break
+            for url, digest in rows:
+                self._db.execute('DELETE FROM pages WHERE url = ?', (url,))
+                self._dropunused([digest])
+                if self.size <= self.maxsize:
+                    break
+
+
+def retryafter(value) -> float:
+    """响应头Retry-After表示的等待秒数,它可以是秒数或者一个HTTP日期"""
+    if not value:
+        return 0
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+class _Host(object):
+    """HostScheduler中一个主机的状态"""
+    __slots__ = ('limit', 'rate', 'active', 'nextstart', 'blocked',
+                 'cooldown', 'best', 'interval', 'laststart',
+                 'requests', 'throttled', 'slow', 'bytes', 'first', 'last')
+
+    def __init__(self, limit, rate):
+        self.limit = limit  # 并发请求数的上限
+        self.rate = rate  # 每秒请求数的上限,None为不限制
+        self.active = 0
+        self.nextstart = 0  # 按rate下一个请求最早开始的时间
+        self.blocked = 0  # 按Retry-After在这个时间之前不发出请求
+        self.cooldown = 0  # 在这个时间之前不因为响应慢而再次降低上限
+        self.best = None  # 观察到的最短的响应时间
+        self.interval = None  # 请求开始的平均间隔
+        self.laststart = None
+        self.requests = 0
+        self.throttled = 0
+        self.slow = 0
+        self.bytes = 0
+        self.first = None
+        self.last = None
+
+
+class HostScheduler(object):
+    """按主机调度请求,限制每个主机的并发请求数与请求频率,
+    并以AIMD(加性增,乘性减)的方式调整它们:
+        并发上限用满时,每个正常的响应使它增加1/上限(每一轮请求约增加1),
+        有频率上限时每秒约增加step;
+        服务器回答429/503时,并发上限与频率上限都减半,并发上限已经是1时
+        才开始限制频率(以当时的请求频率的一半作为上限),
+        Retry-After之前不再向它发出请求;同时被拒绝的一批请求只减半一次;
+        响应时间超过观察到的最短响应时间的slow倍(至少为0.05秒)时,
+        并发上限减半,一个响应时间之内最多减半一次.
+    它可以被多个Fetcher(以及多个线程)共用,对同一主机的请求共同受到限制
+    concurrency/maxconcurrency: 每个主机开始时与最大的并发请求数
+    rate/maxrate/minrate: 每个主机开始时,最大与最小的每秒请求数,
+        rate为None时开始时不限制频率
+    """
+
+    def __init__(self, concurrency: int = 8, maxconcurrency: int = 64,
+                 rate: float = None, maxrate: float = 1000,
+                 minrate: float = 0.2, step: float = 1, slow: float = 4):
+        self.concurrency = concurrency
+        self.maxconcurrency = maxconcurrency
+        self.rate = rate
+        self.maxrate = maxrate
+        self.minrate = minrate
+        self.step = step
+        self.slow = slow
+        self._hosts = {}
+        self._cond = threading.Condition()
+
+    def _host(self, host: str) -> _Host:
+        h = self._hosts.get(host)
+        if h is None:
+            h = self._hosts[host] = _Host(self.concurrency, self.rate)
+        return h
+
+    def acquire(self, host: str):
+        """等待直到可以向host发出一个请求,请求完成后需要调用release()"""
+        with self._cond:
+            h = self._host(host)
+            while True:
+                now = time.monotonic()
+                wait = max(h.blocked, h.nextstart) - now
+                if h.active < int(h.limit) and wait <= 0:
+                    break
+                self._cond.wait(wait if wait > 0 else None)
+            h.active += 1
+            if h.rate is not None:
+                h.nextstart = max(now, h.nextstart) + 1 / h.rate
+            if h.laststart is not None:
+                gap = now - h.laststart
+                h.interval = gap if h.interval is None else \
+                    h.interval * 0.8 + gap * 0.2
+            h.laststart = now
+            if h.first is None:
+                h.first = now
+
+    def release(self, host: str, status: int = None, elapsed: float = 0,
+                retry: float = 0, size: int = 0):
+        """一个请求完成了
+        status: 状态码,请求失败(没有得到响应)时为None
+        elapsed: 请求所用的时间(秒)
+        retry: 响应头Retry-After表示的等待秒数
+        size: 接收到的字节数
+        """
+        with self._cond:
+            h = self._host(host)
+            now = time.monotonic()
+            saturated = h.active >= int(h.limit)  # 并发上限是否已经用满
+            h.active -= 1
+            h.requests += 1
+            h.bytes += size
+            h.last = now
+            if status in _THROTTLED:
+                h.throttled += 1
+                h.blocked = max(h.blocked, now + retry)
+                if now >= h.cooldown:
+                    # 同时发出的请求可能一起被拒绝,它们只算一次
+                    h.cooldown = now + max(retry, elapsed, h.best or 0)
+                    if h.rate is None and h.limit < 2:
+                        # 并发已经降到1了还是太快,开始限制频率
+                        h.rate = 1 / max(h.interval or elapsed, 0.001)
+                    h.limit = max(h.limit / 2, 1)
+                    if h.rate is not None:
+                        h.rate = max(h.rate / 2, self.minrate)
+                        h.nextstart = now + 1 / h.rate
+            elif status is not None:
+                if h.best is None or elapsed < h.best:
+                    h.best = elapsed
+                if elapsed > self.slow * max(h.best, 0.05):
+                    h.slow += 1
+                    if now >= h.cooldown:
+                        h.limit = max(h.limit / 2, 1)
+                        h.cooldown = now + elapsed
+                else:
+                    if saturated:
+                        h.limit = min(h.limit + 1 / h.limit,
+                                      self.maxconcurrency)
+                    if h.rate is not None:
+                        h.rate = min(h.rate + self.step / h.rate,
+                                     self.maxrate)
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        """每个主机的统计:
+        {主机: {'requests': 请求数, 'throttled': 429/503的次数,
+               'slow': 响应慢的次数, 'bytes': 接收到的字节数,
+               'throughput': 平均每秒完成的请求数,
+               'concurrency': 当前的并发上限, 'rate': 当前的频率上限}}
+        """
+        with self._cond:
+            return {host: {'requests': h.requests,
+                           'throttled': h.throttled,
+                           'slow': h.slow,
+                           'bytes': h.bytes,
+                           'throughput': h.requests / (h.last - h.first)
+                           if h.last and h.last > h.first else 0.0,
+                           'concurrency': int(h.limit),
+                           'rate': h.rate}
+                    for host, h in self._hosts.items()}
+
+
+class Fetcher(object):
+    """页面下载器,它可以在多个线程中同时使用
+    每个主机最多保持maxidle个空闲的持久连接,请求完成后连接回到连接池中,
+    下一个对同一主机的请求直接使用它,不需要再次建立TCP(及TLS)连接.
+    请求时声明接受gzip/deflate压缩的内容,并自动解压.
+    timeout: 连接与读取的超时(秒)
+    headers: 附加的请求头
+    proxies: {协议: 代理的url},默认与urllib相同,取自环境变量http_proxy/https_proxy,
+        no_proxy中的主机不使用代理.http请求直接发给代理,
+        https请求经过代理以CONNECT建立的隧道发出.代理的url中可以有用户名与密码
+    cache: 页面的磁盘缓存HttpCache,为None时不使用缓存
+    scheduler: 按主机调度请求的HostScheduler,为None时不限制.
+        服务器回答429/503时,请求经过scheduler的等待后重新发出,
+        最多throttleretries次
+    retries: 请求失败(超时,连接错误,状态码429/5xx)时最多重试的次数,
+        第n次重试前等待0到min(backoff * 2 ** (n - 1), maxbackoff)之间的
+        随机秒数(有Retry-After时至少等待它指定的时间,但不超过maxbackoff).
+        重试之后还是失败时引发OSError(包括URLError/HTTPError)
+    统计:connections为建立的连接数,requests为请求数,
+        received为接收到的内容字节数(解压前),decoded为解压后的字节数,
+        cached为直接使用缓存(没有请求)的次数,notmodified为重新验证后
+        使用缓存的次数,retried为失败后重试的次数
+    """
+
+    def __init__(self, maxidle: int = 8, timeout: float = 30,
+                 headers: dict = None, cache: HttpCache = None,
+                 scheduler: HostScheduler = None, throttleretries: int = 5,
+                 retries: int = 3, backoff: float = 0.5,
+                 maxbackoff: float = 30, proxies: dict = None):
+        self.maxidle = maxidle
+        self.timeout = timeout
+        self.headers = {'User-Agent': 'Mozilla/5.0 (compatible; epub)',
+                        'Accept-Encoding': 'gzip, deflate'}
+        self.headers.update(headers or {})
+        self.connections = 0
+        self.requests = 0
+        self.received = 0
+        self.decoded = 0
+        self.cached = 0
+        self.notmodified = 0
+        self.cache = cache
+        self.scheduler = scheduler
+        self.throttleretries = throttleretries
+        self.retries = retries
+        self.backoff = backoff
+        self.maxbackoff = maxbackoff
+        self.retried = 0
+        self.proxies = getproxies() if proxies is None else proxies
+        self._idle = {}  # (scheme, host, port) -> [空闲的连接]
+        self._routes = {}  # (scheme, host, port) -> _proxy()的结果
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def close(self):
+        """关闭连接池中所有空闲的连接"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _connect(self, key):
+        """从连接池中取出一个空闲的连接,没有时建立一个.返回(连接, 是否复用)"""
+        with self._lock:
+            conns = self._idle.get(key)
+            if conns:
+                return conns.pop(), True
+            self.connections += 1
+        scheme, host, port = key
+        proxy = self._proxy(key)
+        if proxy is None:
+            if scheme == 'https':
+                return http.client.HTTPSConnection(
+                    host, port, timeout=self.timeout), False
+            return http.client.HTTPConnection(host, port,
+                                              timeout=self.timeout), False
+        proxyhost, proxyport, auth = proxy
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(proxyhost, proxyport,
+                                               timeout=self.timeout)
+            conn.set_tunnel(host, port, auth)
+            return conn, False
+        return http.client.HTTPConnection(proxyhost, proxyport,
+                                          timeout=self.timeout), False
+
+    def _proxy(self, key):
+        """访问key=(scheme, host, port)使用的代理,返回(代理的主机, 端口,
+        代理认证的请求头),不使用代理时为None
+        """
+        if key in self._routes:
+            return self._routes[key]
+        scheme, host, port = key
+        proxy = self.proxies.get(scheme)
+        route = None
+        if proxy and not proxy_bypass(host if port is None else
+                                      '{}:{}'.format(host, port)):
+            if '://' not in proxy:
+                proxy = 'http://' + proxy
+            parts = urlsplit(proxy)
+            auth = {}
+            if parts.username is not None:
+                credentials = '{}:{}'.format(unquote(parts.username),
+                                             unquote(parts.password or ''))
+                auth['Proxy-Authorization'] = 'Basic ' + base64.b64encode(
+                    credentials.encode('utf-8')).decode('ascii')
+            route = (parts.hostname,
+                     parts.port or (443 if parts.scheme == 'https' else 80),
+                     auth)
+        self._routes[key] = route
+        return route
+
+    def _release(self, key, conn):
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self.maxidle:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def _request(self, url: str, headers: dict = None):
+        """发出一个GET请求,返回(状态码, 响应头, 未解压的内容)
+        headers: 这个请求附加的请求头
+        """
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError('unsupported url: ' + url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        if headers:
+            headers = dict(self.headers, **headers)
+        proxy = self._proxy(key)
+        if proxy is not None and parts.scheme == 'http':
+            # 经过代理的http请求使用完整的url
+            path = urlunsplit(('http', parts.netloc, path, '', ''))
+            if proxy[2]:
+                headers = dict(headers or self.headers, **proxy[2])
+        while True:
+            conn, reused = self._connect(key)
+            try:
+                conn.request('GET', path, headers=headers or self.headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError,
+                    BrokenPipeError, http.client.BadStatusLine):
+                conn.close()
+                if reused:
+                    continue  # 服务器已经关闭了这个空闲的连接,换一个连接重试
+                raise
+            except BaseException:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(key, conn)
+            return response.status, response.msg, body
+
+    def fetch(self, url: str) -> Response:
+        """下载url,跟随重定向.状态码不是2xx时引发urllib.error.HTTPError
+        超时,连接错误与429/5xx按retries重试
+        有缓存时先查找缓存,见HttpCache
+        """
+        entry = None
+        validators = None
+        if self.cache is not None:
+            entry = self.cache.lookup(url)
+            if entry is not None and (self.cache.offline or
+                                      self.cache.isimmutable(entry)):
+                response = self.cache.response(entry)
+                if response is not None:
+                    with self._lock:
+                        self.cached += 1
+                    return response
+                entry = None
+            if entry is None and self.cache.offline:
+                raise URLError('not in cache (offline): ' + url)
+            if entry is not None:
+                validators = self.cache.validators(entry)
+        target = url
+        redirects = throttled = failures = 0
+        while True:
+            try:
+                status, headers, body = self._scheduled(target, validators)
+            except (OSError, http.client.HTTPException) as e:
+                if failures >= self.retries:
+                    if isinstance(e, OSError):
+                        raise
+                    raise URLError(e)
+                failures += 1
+                self._wait(failures)
+                continue
+            with self._lock:
+                self.requests += 1
+                self.received += len(body)
+            if status in _THROTTLED and self.scheduler is not None and \
+                    throttled < self.throttleretries:
+                throttled += 1
+                continue
+            if status in _TRANSIENT and failures < self.retries:
+                failures += 1
+                self._wait(failures, retryafter(headers.get('Retry-After')))
+                continue
+            if status in _REDIRECTS and headers.get('Location'):
+                redirects += 1
+                if redirects > _MAX_REDIRECTS:
+                    raise HTTPError(target, status, 'too many redirects',
+                                    headers, None)
+                target = urljoin(target, headers['Location'])
+                continue
+            if status == 304 and entry is not None:
+                response = self.cache.response(entry)
+                if response is not None:
+                    with self._lock:
+                        self.notmodified += 1
+                    return response
+                entry = validators = None  # 缓存的内容不见了,重新请求
+                continue
+            if not 200 <= status < 300:
+                raise HTTPError(target, status, http.client.responses.get(
+                    status, ''), headers, None)
+            body = decodebody(body, headers.get('Content-Encoding'))
+            with self._lock:
+                self.decoded += len(body)
+            if self.cache is not None:
+                self.cache.store(url, headers, body)
+            return Response(target, status, headers, body)
+
+    def _wait(self, failures: int, retry: float = 0):
+        """第failures次重试之前的等待:带随机抖动的指数退避"""
+        with self._lock:
+            self.retried += 1
+        limit = min(self.backoff * 2 ** (failures - 1), self.maxbackoff)
+        time.sleep(max(random.uniform(0, limit), min(retry, self.maxbackoff)))
+
+    def _scheduled(self, url: str, extra: dict = None):
+        """经过scheduler的调度发出请求,参数与返回值都与_request()相同"""
+        if self.scheduler is None:
+            return self._request(url, extra)
+        host = urlsplit(url).netloc
+        self.scheduler.acquire(host)
+        start = time.monotonic()
+        try:
+            status, headers, body = self._request(url, extra)
+        except BaseException:
+            self.scheduler.release(host, None, time.monotonic() - start)
+            raise
+        self.scheduler.release(host, status, time.monotonic() - start,
+                               retryafter(headers.get('Retry-After')),
+                               len(body))
+        return status, headers, body
+
+    def get(self, url: str, encode: str = 'utf-8') -> str:
+        """下载url并解码为文本,字符集见Response.text()"""
+        return self.fetch(url).text(encode)
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def sharedfetcher() -> Fetcher:
+    """进程中共用的下载器,爬虫没有指定下载器时使用它
+    它使用一个HostScheduler,同一进程中同时进行的所有抓取共同受到它的调度
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = Fetcher(scheduler=HostScheduler())
+        return _shared
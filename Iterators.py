@@ -1,10 +1,21 @@
 # -*- coding: utf-8 -*-
 """EpubCreater.source常用的迭代器及辅助功能"""
 
-from urllib.request import urlopen
 import re
+import sys
+import asyncio
+import base64
 import os
+import codecs
+import hashlib
+import json
+import mmap
+import zlib
+from collections import deque
+from html import escape
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from OPF import XhtmlDoc
+from Fetcher import sharedfetcher
 
 
 def default_textengine(line):
@@ -63,15 +74,25 @@ def htmltodoc(html, filename, titlere, linere,
     return XhtmlDoc(filename, title, data)
 
 
+def faileddoc(filename, title, url, error):
+    """下载失败的页面的占位文档,它是未完成的(complete为False)
+    之后重新下载成功时可以设置它的title/data并置complete为True,
+    写入epub时仍未完成的文档记录在EpubCreater.incomplete中
+    """
+    return XhtmlDoc(filename, title,
+                    '<p>下载失败: {} ({})</p>'.format(escape(url),
+                                                    escape(str(error))),
+                    complete=False)
+
+
 def filetodoc(filename: str, encode: str = 'utf-8',
               textengine=default_textengine):
-    lines = []
+    """整个文件生成一个文档,每行文字由textengine处理"""
+    doc = XhtmlDoc(filename, os.path.basename(filename))
     with open(filename, 'r', encoding=encode) as f:
-        for line in f:
-            lines.append(textengine(line))
-    return XhtmlDoc(filename,
-                    os.path.basename(filename),
-                    '\n'.join(lines))
+        for i, line in enumerate(f):
+            doc.append(('\n' if i else '') + textengine(line))
+    return doc
 
 
 def dirtodoc(path: str, dirnames):
@@ -92,22 +113,27 @@ def dirtodoc(path: str, dirnames):
     True
     """
     t_path = os.path.split(path)
-    data = '  <h3>目录中的文件列表:</h3>\n  <ui>\n'
+    doc = XhtmlDoc(filename=dirnames[path],
+                   title=t_path[1],
+                   data='  <h3>目录中的文件列表:</h3>\n  <ui>\n',
+                   parentsrc=dirnames[t_path[0]])
     for file in os.scandir(path):
+        if file.name.startswith('.'):
+            continue  # 与eachfiles一致,不列出隐藏文件
         if file.is_file():
-            data += '    <li>{}</li>\n'.format(file.name)
+            doc.append('    <li>{}</li>\n'.format(file.name))
         else:
-            data += '    <li>[目录]:{}</li>\n'.format(file.name)
-    data += '  </ui>'
-    return XhtmlDoc(filename=dirnames[path],
-                    title=t_path[1],
-                    data=data,
-                    parentsrc=dirnames[t_path[0]])
+            doc.append('    <li>[目录]:{}</li>\n'.format(file.name))
+    doc.append('  </ui>')
+    return doc
+
+
+_ALTSEP = os.altsep or '/'  # iter_dir/eachfiles使用的路径分隔符
 
 
 def eachfiles(home, exts='*', includesubdir=True):
     """遍历目录中每一个文件名
-    * 注意,文件的路径分隔符将始终强制为os.altsep
+    * 注意,文件的路径分隔符将始终强制为os.altsep(没有os.altsep的系统上为"/")
     >>> for filename in eachfiles('D:/Python/baseweb'):
     ...    filename
     'D:/Python/baseweb/app.py'
@@ -121,11 +147,14 @@ def eachfiles(home, exts='*', includesubdir=True):
                       re.I)
     home = [home]
     for path in home:
-        for file in os.listdir(path):
-            if file.startswith('.'):
-                pass
-            file = os.path.join(path, file).replace(os.sep, os.altsep)
-            if os.path.isdir(file):
+        # scandir在读目录时就得到了条目的类型,不需要再对每个条目调用stat
+        with os.scandir(path) as it:
+            entries = list(it)
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue  # 隐藏文件,以及索引/编码缓存之类的附属文件
+            file = os.path.join(path, entry.name).replace(os.sep, _ALTSEP)
+            if entry.is_dir():
                 if includesubdir:
                     home.append(file)
             elif exts.match(file.split('.')[-1]):
@@ -147,13 +176,16 @@ def getfileencode(file):
     >>> getfileencode(r'D:/Python/baseweb\\app.py')
     'utf_8'
     """
-    codes = ['utf_8', 'utf_16', 'gb18030', 'big5']
     with open(file, 'rb') as f:
-        b = f.read()
-        for code in codes:
+        bom = f.read(3)
+        for code in _ENCODES:
+            f.seek(0)
+            decoder = _decoder(code, bom)
             try:
-                b.decode(code)
-                if code == 'utf_8' and b.startswith(b'\xef\xbb\xbf'):
+                for block in iter(lambda: f.read(_SCAN_BLOCK), b''):
+                    decoder.decode(block)
+                decoder.decode(b'', True)
+                if code == 'utf_8' and bom == codecs.BOM_UTF8:
                     code = 'utf_8_sig'
                 break
             except (Exception,):
@@ -161,6 +193,359 @@ def getfileencode(file):
     return code
 
 
+_ENCODES = ('utf_8', 'utf_16', 'gb18030', 'big5')  # 依次尝试的编码
+_SAMPLE_SIZE = 1 << 14  # 抽样检测编码时每个样本的字节数
+_re_nonascii = re.compile(rb'[\x80-\xff]')
+
+
+def _decoder(code: str, bom: bytes = b''):
+    """code的增量解码器
+    没有BOM时utf_16与bytes.decode()一样按本机的字节序解码
+    """
+    if code == 'utf_16' and \
+            not bom.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        code = 'utf_16_le' if sys.byteorder == 'little' else 'utf_16_be'
+    return codecs.getincrementaldecoder(code)()
+
+
+def _decodable(sample: bytes, code: str, head: bool, tail: bool) -> bool:
+    """sample能否以code解码
+    head/tail: sample是否位于文件的开始/结束,不是时它的两端可能是不完整的字符:
+        开始处依次尝试跳过0-3个字节(utf_16为0或2个),结束处不完整的字符被忽略
+    """
+    skips = [0] if head else [0, 2] if code == 'utf_16' else [0, 1, 2, 3]
+    for skip in skips:
+        try:
+            _decoder(code).decode(sample[skip:], tail)
+            return True
+        except UnicodeDecodeError:
+            continue
+    return False
+
+
+def detectencode(file, samplesize: int = _SAMPLE_SIZE) -> tuple:
+    """抽样检测文本文件的编码,返回(编码, 可信度)
+    与getfileencode按同样的顺序尝试编码,但它不读出整个文件:
+    有BOM时直接由BOM决定;文件不大于3个样本时检测整个文件,它们的可信度为1.0.
+    否则只检测开始,中间与结尾三个样本,可信度为0.9乘以含有非ascii字符的样本
+    所占的比例:只含ascii字符的样本对多字节编码没有区分能力.
+    没有能解码全部样本的编码时返回(getfileencode的最后一个编码, 0.0)
+    """
+    size = os.path.getsize(file)
+    with open(file, 'rb') as f:
+        head = f.read(min(size, samplesize))
+        if head.startswith(codecs.BOM_UTF8):
+            return 'utf_8_sig', 1.0
+        if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+            return 'utf_16', 1.0
+        if size <= samplesize * 3:
+            f.seek(0)
+            samples = [(f.read(), True, True)]
+        else:
+            samples = [(head, True, False)]
+            for pos in ((size - samplesize) // 2 & ~1, size - samplesize):
+                f.seek(pos)
+                samples.append((f.read(samplesize), False,
+                                pos + samplesize >= size))
+    for code in _ENCODES:
+        if code == 'utf_16' and size % 2:
+            continue  # 样本可能都是偶数长度的,但整个文件不能以utf_16解码
+        if all(_decodable(sample, code, h, t) for sample, h, t in samples):
+            break
+    else:
+        return code, 0.0
+    if len(samples) == 1:
+        return code, 1.0
+    evidence = sum(1 for sample, _, _ in samples if _re_nonascii.search(sample))
+    return code, 0.9 * evidence / len(samples)
+
+
+def fileencode(file, threshold: float = 0.5) -> tuple:
+    """以detectencode抽样检测文件的编码,可信度低于threshold时以getfileencode
+    完整地验证文件.返回(编码, 可信度)
+    """
+    code, confidence = detectencode(file)
+    if confidence < threshold:
+        code, confidence = getfileencode(file), 1.0
+    return code, confidence
+
+
+def _savejson(filename: str, obj):
+    """将obj以json格式保存到文件中(先写入临时文件再替换),不能写入时忽略它"""
+    try:
+        with open(filename + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(json.dumps(obj, ensure_ascii=False))
+        os.replace(filename + '.tmp', filename)
+    except OSError:
+        pass
+
+
+class EncodeCache(object):
+    """文件编码的缓存
+    检测的结果按目录保存在目录中的文件.encodes.json中,以文件名为键,
+    记录文件的大小,修改时间,编码与可信度,文件的大小或修改时间改变后重新检测.
+    目录不能写入时,结果只在本次使用中有效.
+    threshold: 抽样检测的可信度低于它时,以getfileencode完整地验证文件
+    """
+    filename = '.encodes.json'
+
+    def __init__(self, threshold: float = 0.5):
+        self.threshold = threshold
+        self._dirs = {}  # 目录: [{文件名: 记录}, 是否有改变]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.save()
+
+    def _records(self, dirname: str) -> list:
+        """目录dirname的缓存记录"""
+        if dirname not in self._dirs:
+            try:
+                with open(os.path.join(dirname, self.filename), 'r',
+                          encoding='utf-8') as f:
+                    records = json.load(f)
+            except (OSError, ValueError):
+                records = {}
+            self._dirs[dirname] = [records, False]
+        return self._dirs[dirname]
+
+    def getencode(self, file) -> str:
+        """文件file的编码"""
+        code = self.lookup(file)
+        if code is None:
+            code, confidence = fileencode(file, self.threshold)
+            self.record(file, code, confidence)
+        return code
+
+    def lookup(self, file) -> str:
+        """缓存中文件file的编码,没有缓存或者文件已经改变时返回None"""
+        dirname, name = os.path.split(os.path.abspath(file))
+        stat = os.stat(file)
+        record = self._records(dirname)[0].get(name)
+        if record is None or record[:2] != [stat.st_size, stat.st_mtime_ns]:
+            return None
+        return record[2]
+
+    def record(self, file, code: str, confidence: float):
+        """将文件file的编码记录到缓存中"""
+        dirname, name = os.path.split(os.path.abspath(file))
+        stat = os.stat(file)
+        entry = self._records(dirname)
+        entry[0][name] = [stat.st_size, stat.st_mtime_ns, code, confidence]
+        entry[1] = True
+
+    def save(self):
+        """保存有改变的缓存记录,不能写入的目录被忽略"""
+        for dirname, entry in self._dirs.items():
+            if not entry[1]:
+                continue
+            _savejson(os.path.join(dirname, self.filename), entry[0])
+            entry[1] = False
+
+
+class _Journal(object):
+    """抓取的日志文件,用于在抓取中断后继续
+    第一行记录抓取的参数args,此后每行是一个已经下载的页面:
+        {"url": 页面的url, "title": 标题, "data": 内容, ...附加的字段}
+    记录按行追加,每checkpoint个记录刷新并同步到磁盘一次,因此进程被杀死或者
+    主机重启时最多失去最后checkpoint个记录.末尾不完整的行在打开时被截去.
+    参数与args不一致的日志无效,它被清空后重新记录.
+    内存中只保存每个url的记录在文件中的位置,记录的内容在用到时才读出
+    """
+
+    def __init__(self, filename: str, args: list, checkpoint: int = 20):
+        self.checkpoint = checkpoint
+        self._offsets = {}  # url -> 记录在文件中的位置
+        self._unsynced = 0
+        good = self._load(filename, args)
+        self._file = open(filename, 'a+b')
+        self._file.truncate(good)
+        if not good:
+            self._write({'args': args})
+
+    def _load(self, filename: str, args: list) -> int:
+        """读出已有的记录,返回有效内容的长度,没有有效的内容时为0"""
+        try:
+            f = open(filename, 'rb')
+        except OSError:
+            return 0
+        with f:
+            good = 0
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # 写入到一半的记录
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    break
+                if not good:
+                    if record != {'args': args}:
+                        return 0
+                else:
+                    self._offsets[record['url']] = good
+                good += len(line)
+            return good
+
+    def _write(self, record: dict):
+        self._file.write(json.dumps(record, ensure_ascii=False)
+                         .encode('utf-8') + b'\n')
+        self._unsynced += 1
+        if self._unsynced >= self.checkpoint:
+            self.sync()
+
+    def __contains__(self, url: str) -> bool:
+        return url in self._offsets
+
+    def get(self, url: str):
+        """url的记录,没有时为None"""
+        offset = self._offsets.get(url)
+        if offset is None:
+            return None
+        self._file.flush()
+        self._file.seek(offset)
+        return json.loads(self._file.readline().decode('utf-8'))
+
+    def record(self, url: str, doc, **extra):
+        """记录已经下载的页面url生成的文档doc"""
+        self._file.seek(0, os.SEEK_END)
+        self._offsets[url] = self._file.tell()
+        extra.update(url=url, title=doc.title, data=doc.data)
+        self._write(extra)
+
+    def replay(self, record: dict, namegen):
+        """由记录重建文档,它的名字仍然取自namegen"""
+        return XhtmlDoc(next(namegen), record['title'], record['data'])
+
+    def sync(self):
+        """将已经写入的记录同步到磁盘"""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def close(self):
+        try:
+            self.sync()
+        finally:
+            self._file.close()
+
+
+def _openjournal(journal: str, *args):
+    """journal不为''时打开抓取日志,args为决定页面内容的参数"""
+    if not journal:
+        return None
+    return _Journal(journal, [args[0].__name__] + [
+        '{}.{}'.format(a.__module__, a.__qualname__) if callable(a) else a
+        for a in args[1:]])
+
+
+def _predict(history, count: int) -> list:
+    """由最近三页的参数history推测之后count页的参数
+    每个参数都不变,或者都是以固定步长变化的整数(保留前导0)时才能推测,
+    否则返回[]
+    >>> _predict([('a', 8), ('a', '09'), ('a', '10')], 2)
+    [['a', '11'], ['a', '12']]
+    >>> _predict([('a', 8), ('a', '10'), ('a', '11')], 2)
+    []
+    """
+    if len(history) < 3:
+        return []
+    a, b, c = ([str(x) for x in p] for p in history[-3:])
+    if not len(a) == len(b) == len(c):
+        return []
+    steps = []
+    for x, y, z in zip(a, b, c):
+        if x == y == z:
+            steps.append(0)
+            continue
+        if not (x.isdigit() and y.isdigit() and z.isdigit()):
+            return []
+        step = int(z) - int(y)
+        if step != int(y) - int(x):
+            return []
+        steps.append(step)
+    if not any(steps):
+        return []
+    predicted = []
+    for _ in range(count):
+        c = [v if not step else
+             str(int(v) + step).zfill(len(v) if v[:1] == '0' else 1)
+             for v, step in zip(c, steps)]
+        predicted.append(c)
+    return predicted
+
+
+class _Speculator(object):
+    """iter_url的推测下载
+    下一页的参数已知后,立即开始下载下一页,并由参数的变化规律(见_predict)
+    推测再后面ahead页的参数,同时下载它们.推测的页面在真正轮到它时才被证实,
+    与实际的下一页不一致的推测被放弃.
+    stats: {'predicted': 推测下载的页面数, 'hits': 被证实的推测数,
+            'wasted': 被放弃的推测数}
+    """
+
+    def __init__(self, get, url_fmt: str, encode: str, ahead: int,
+                 stats: dict = None):
+        self.url_fmt = url_fmt
+        self.encode = encode
+        self.ahead = ahead
+        self.stats = stats if stats is not None else {}
+        self.stats.update(predicted=0, hits=0, wasted=0)
+        self._get = _trypage(get)
+        self._pool = ThreadPoolExecutor(ahead + 1)
+        self._futures = {}  # url -> (future, 是否是推测的)
+        self._history = deque(maxlen=3)
+
+    def get(self, url: str) -> str:
+        """下载url,已经开始下载时等待它的结果"""
+        future, speculative = self._futures.pop(url, (None, False))
+        if future is None:
+            html, error = self._get(url, self.encode)
+        else:
+            if speculative:
+                self.stats['hits'] += 1
+            html, error = future.result()
+        if error is not None:
+            raise error
+        return html
+
+    def advance(self, params, nextparams, remain: int, skip=()):
+        """当前页的参数为params,下一页的参数为nextparams(没有下一页时为None)
+        放弃推测错误的下载,开始下载下一页及推测的后续页面
+        remain: 还需要的页面数(包括下一页),小于0时不做限制
+        skip: 不需要下载的url(比如抓取日志中已有的页面)
+        """
+        self._history.append(params)
+        targets = {}
+        if nextparams is not None and remain != 0:
+            ahead = self.ahead if remain < 0 else min(self.ahead, remain - 1)
+            guesses = [nextparams] + _predict(
+                list(self._history) + [nextparams], ahead)
+            for i, guess in enumerate(guesses):
+                try:
+                    targets[self.url_fmt.format(*guess)] = i > 0
+                except IndexError:
+                    break
+        for url in [url for url in self._futures if url not in targets]:
+            future, speculative = self._futures.pop(url)
+            future.cancel()
+            if speculative:
+                self.stats['wasted'] += 1
+        for url, speculative in targets.items():
+            if url in self._futures or url in skip:
+                continue
+            self._futures[url] = (self._pool.submit(self._get, url,
+                                                    self.encode),
+                                  speculative)
+            if speculative:
+                self.stats['predicted'] += 1
+
+    def close(self):
+        self.advance(None, None, 0)
+        self._pool.shutdown()
+
+
 def iter_url(url_fmt, *url_params,
              paramre='nextpage="/(\\w+)/(\\w+).html',
              titlere='<title>(\.+)</title>',
@@ -168,7 +553,11 @@ def iter_url(url_fmt, *url_params,
              textengine=default_textengine,
              encode='utf-8',
              maxget=-1,
-             namegen=autoname()):
+             namegen=None,
+             fetcher=None,
+             journal='',
+             speculate=0,
+             stats=None):
     """从指定网络页面开始循环抓取内容生成xhtml
     url_fmt/url_params: 使用它来生成每个页面的url
         在url_fmt中每个{}将被url_params中的内容替换
@@ -179,9 +568,24 @@ def iter_url(url_fmt, *url_params,
     titlere: 正则表达式,用于从当前页面提取页面的标题,只使用第一个匹配的结果
     linere: 正则表达式,用于从页面内容中获取每一段内容
     textengine: 行处理器,只用于内容行
-    decode: 页面的编码格式,默认按utf-8处理
+    encode: 页面的编码格式,只在响应头与页面的<meta>中都没有给出字符集时使用
     maxget: 最大迭代次数,指定小于0的值则不做限制
         当只准备获取页面序列中前面一部分时,它很有用
+    fetcher: 下载页面使用的Fetcher.Fetcher,默认为进程中共用的下载器,
+        超时等暂时性的错误由它重试(见Fetcher.retries)
+    重试之后仍然下载失败时,这一页以未完成的占位文档(见faileddoc)代替,
+    由于无法得知下一页的地址,迭代在此结束
+    journal: 抓取日志的文件名,给出时每个下载的页面(及它的下一页参数)都记录在其中,
+        定期同步到磁盘.抓取中断后以同样的参数再次迭代(比如再次createepub或
+        recreate)时,日志中的页面直接由记录重建,它们的文档名仍依次取自namegen,
+        从最后一个记录的下一页继续下载.没有下一页的最后一页不记录,每次都
+        重新下载,因此抓取完成后再次迭代时,连载中新增加的页面也会被下载
+    speculate: 推测下载的页面数.大于0时,下一页在当前页迭代出去之前就开始下载,
+        如果前几页的参数以固定的步长递增(比如递增的章节编号),再推测后续
+        speculate页的参数并同时下载它们.推测只在真正轮到那一页时才被证实,
+        推测错误的下载被放弃,迭代出的文档与不推测时完全相同
+    stats: 一个dict,给出它时记录推测下载的统计:predicted为推测下载的页面数,
+        hits为被证实的推测数,wasted为被放弃的推测数,命中率为hits/predicted
     >>> it = iter_url('https://www.xxbiquge.com/{}/{}.html',
     ...               '26_26345', 1466511,
     ...               titlere='<h1>(.+?)</h1>',
@@ -192,25 +596,59 @@ def iter_url(url_fmt, *url_params,
     第二章 义庄(3847)
     第三章 泔水与饥饿(3931)
     """
+    if namegen is None:
+        namegen = autoname()
+    fetcher = fetcher or sharedfetcher()
     params = list(url_params)
     param_re = re.compile(paramre)
     title_re = re.compile(titlere)
     line_re = re.compile(linere)
-    while params[-1] is not None and maxget != 0:
-        try:
-            url = url_fmt.format(*params)
-            html = urlopen(url).read().decode(encode)
-            yield htmltodoc(html,
-                            filename=next(namegen),
-                            titlere=title_re,
-                            linere=line_re,
-                            textengine=textengine)
-            params = param_re.findall(html)[0]
+    journal = _openjournal(journal, iter_url, paramre, titlere, linere,
+                           textengine)
+    speculator = None
+    if speculate > 0:
+        speculator = _Speculator(fetcher.get, url_fmt, encode, speculate,
+                                 stats)
+    try:
+        while params[-1] is not None and maxget != 0:
+            try:
+                url = url_fmt.format(*params)
+            except IndexError:
+                return  # 参数不能满足url_fmt的需要
+            record = journal and journal.get(url)
+            if record is not None and record['next'] is not None:
+                doc = journal.replay(record, namegen)
+                nextparams = record['next']
+            else:
+                try:
+                    html = speculator.get(url) if speculator else \
+                        fetcher.get(url, encode)
+                except OSError as e:
+                    yield faileddoc(next(namegen), '', url, e)
+                    return
+                doc = htmltodoc(html,
+                                filename=next(namegen),
+                                titlere=title_re,
+                                linere=line_re,
+                                textengine=textengine)
+                nextparams = param_re.findall(html)
+                nextparams = nextparams[0] if nextparams else None
+                if journal and nextparams is not None:
+                    # 最后一页不记录,连载增加了新的章节后它会有下一页
+                    journal.record(url, doc, next=nextparams)
+            if speculator:
+                speculator.advance(params, nextparams, maxget - 1,
+                                   journal or ())
+            yield doc
+            params = nextparams
+            if params is None:
+                return  # 没有下一页
             maxget -= 1
-        except (Exception,):
-            # 可能没有下一页，param_re.findall()[0]产生错误
-            # 迭代完毕
-            raise StopIteration
+    finally:
+        if speculator:
+            speculator.close()
+        if journal:
+            journal.close()
 
 
 def iter_page(url, hrefre,
@@ -219,8 +657,28 @@ def iter_page(url, hrefre,
               textengine=default_textengine,
               encode='utf-8',
               maxget=-1,
-              namegen=autoname()):
+              namegen=None,
+              concurrency=1,
+              fetcher=None,
+              journal='',
+              mark='',
+              state=None):
     """从指定url中的子页面的列表来枚举每个子页面
+    encode: 页面的编码格式,只在响应头与页面的<meta>中都没有给出字符集时使用
+    concurrency: 同时下载的子页面数,见aiter_page
+    fetcher: 下载页面使用的Fetcher.Fetcher,默认为进程中共用的下载器
+    journal: 抓取日志的文件名,见aiter_page
+    mark: 上次生成时记录的续读标记(见state),它记录了已经生成的每个子页面的链接.
+        目录页中开头的链接与标记记录的完全一致时(通常是连载中的小说只在末尾
+        增加了新的章节),跳过这些子页面(以及它们的名字),只下载并迭代此后的
+        子页面.否则完全重新下载
+    state: 一个dict,给出它时记录续读标记,它通常就是createepub()的meta参数,
+        这样标记会保存在epub的source:mark中,recreate()据此只追加新的章节.
+        调用时就下载目录页,state['mark']设为经过验证的mark(无效时为''),
+        迭代完毕后设为新的续读标记,它记录到第一个仍未完成(下载失败)的
+        子页面之前为止
+    它在自己的事件循环中运行aiter_page,因此不能在一个正在运行的事件循环中
+    调用,这时请直接使用aiter_page
     >>> it = iter_page('https://www.xxbiquge.com/26_26345/',
     ...                '<a +href="/[\d_]+?/([\d_]+?\.html)" *>(第.+?)</a>',
     ...                titlere='<h1>(.+?)</h1>',
@@ -231,19 +689,198 @@ def iter_page(url, hrefre,
     第二章 义庄(3847)
     第三章 泔水与饥饿(3931)
     """
+    if state is None and not mark:
+        return _synciter(aiter_page(url, hrefre, titlere, linere, textengine,
+                                    encode, maxget, namegen, concurrency,
+                                    fetcher, journal))
+    if namegen is None:
+        namegen = autoname()
+    hrefs = _findhrefs((fetcher or sharedfetcher()).get(url, encode),
+                       hrefre, maxget)
+    done = checkhrefs(hrefs, mark)
+    if state is not None:
+        state['mark'] = mark if done else ''
+    for _ in range(done):
+        next(namegen)  # 这些子页面已经生成过了
+    return _synciter(_aiter_hrefs(url, hrefs, done, titlere, linere,
+                                  textengine, encode, namegen, concurrency,
+                                  fetcher, journal, state))
+
+
+async def aiter_page(url, hrefre,
+                     titlere='<title>(\.+?)</title>',
+                     linere='&nbsp;&nbsp;&nbsp;&nbsp;(.+?)<',
+                     textengine=default_textengine,
+                     encode='utf-8',
+                     maxget=-1,
+                     namegen=None,
+                     concurrency=4,
+                     fetcher=None,
+                     journal=''):
+    """iter_page的异步版本:
+        async for doc in aiter_page(url, hrefre, ...):
+    子页面在一组线程中下载,同时最多concurrency个,迭代出的文档仍按列表中的顺序.
+    最多只有concurrency个子页面在下载中或等待迭代,因此内存占用与子页面的总数无关
+    maxget: 最多迭代出的文档数,小于0时不做限制
+    fetcher: 下载页面使用的Fetcher.Fetcher,默认为进程中共用的下载器,
+        同一主机的连接在各个线程之间复用
+    重试之后仍然下载失败的子页面以未完成的占位文档(见faileddoc)代替,
+    迭代不会因此中止.其它子页面都迭代完后,再下载一次这些子页面,
+    成功时补全占位文档(title为目录页中链接的文字,没有时为'')
+    journal: 抓取日志的文件名,给出时每个下载的子页面都记录在其中,定期同步到磁盘.
+        抓取中断后以同样的参数再次迭代时,目录页重新下载,日志中已有的子页面
+        直接由记录重建(文档名仍依次取自namegen),只下载其它的子页面
+    """
+    if namegen is None:
+        namegen = autoname()
+    get = _trypage((fetcher or sharedfetcher()).get)
+    with ThreadPoolExecutor(1) as pool:
+        html, error = await asyncio.get_event_loop().run_in_executor(
+            pool, get, url, encode)
+    if error is not None:
+        raise error
+    docs = _aiter_hrefs(url, _findhrefs(html, hrefre, maxget), 0, titlere,
+                        linere, textengine, encode, namegen, concurrency,
+                        fetcher, journal)
+    try:
+        async for doc in docs:
+            yield doc
+    finally:
+        await docs.aclose()  # 迭代没有完成就被关闭时,下载也要停止
+
+
+def _findhrefs(html: str, hrefre: str, maxget: int) -> list:
+    """目录页html中的子页面链接,maxget见aiter_page"""
+    hrefs = re.compile(hrefre).findall(html)
+    return hrefs if maxget < 0 else hrefs[:maxget]
+
+
+def hrefmark(hrefs) -> str:
+    """iter_page的续读标记:子页面的链接列表压缩后的base64编码
+    它只包含字母,数字与-_=,可以直接作为xml属性的值
+    """
+    data = '\n'.join(href[0] if isinstance(href, tuple) else href
+                     for href in hrefs).encode('utf-8')
+    return base64.urlsafe_b64encode(zlib.compress(data, 9)).decode('ascii')
+
+
+def checkhrefs(hrefs: list, mark: str) -> int:
+    """验证iter_page的续读标记
+    mark记录的链接正是hrefs开头的链接时,返回它们的数量,否则返回0
+    >>> checkhrefs([('1.html', 'a'), ('2.html', 'b')], hrefmark(['1.html']))
+    1
+    >>> checkhrefs([('1.html', 'a'), ('2.html', 'b')], hrefmark(['2.html']))
+    0
+    """
+    try:
+        recorded = zlib.decompress(base64.urlsafe_b64decode(
+            mark.encode('ascii'))).decode('utf-8').split('\n')
+    except (AttributeError, ValueError, zlib.error):
+        return 0
+    if len(recorded) > len(hrefs) or any(
+            (href[0] if isinstance(href, tuple) else href) != link
+            for href, link in zip(hrefs, recorded)):
+        return 0
+    return len(recorded)
+
+
+async def _aiter_hrefs(url, hrefs, done, titlere, linere, textengine, encode,
+                       namegen, concurrency, fetcher, journal, state=None):
+    """下载并迭代目录页url中的子页面hrefs[done:],见aiter_page
+    state不为None时,迭代完毕后state['mark']设为记录了已完成的子页面的续读标记
+    """
+    concurrency = max(concurrency, 1)
+    getpage = _trypage((fetcher or sharedfetcher()).get)
     title_re = re.compile(titlere)
     line_re = re.compile(linere)
-    html = urlopen(url).read().decode(encode)
-    for href in re.compile(hrefre).findall(html):
-        html = urlopen(url + href[0]).read().decode(encode)
-        yield htmltodoc(html,
+    loop = asyncio.get_event_loop()
+    pending = deque()  # (future, 子页面的url, 链接的文字),日志中有的future为None
+    failed = []  # (占位文档, 子页面的url, 它在hrefs中的位置)
+    journal = _openjournal(journal, aiter_page, titlere, linere, textengine)
+    pool = ThreadPoolExecutor(concurrency)
+
+    async def nextdoc(future, suburl, title, i):
+        if future is None:
+            return journal.replay(journal.get(suburl), namegen)
+        html, error = await future
+        if error is not None:
+            doc = faileddoc(next(namegen), title, suburl, error)
+            failed.append((doc, suburl, i))
+            return doc
+        doc = htmltodoc(html,
                         filename=next(namegen),
                         titlere=title_re,
                         linere=line_re,
                         textengine=textengine)
-        maxget -= 1
-        if maxget == 0:
-            break
+        if journal:
+            journal.record(suburl, doc)
+        return doc
+
+    try:
+        for i in range(done, len(hrefs)):
+            href = hrefs[i]
+            if not isinstance(href, tuple):
+                href = (href,)
+            suburl = url + href[0]
+            future = None
+            if not (journal and suburl in journal):
+                future = loop.run_in_executor(pool, getpage, suburl, encode)
+            pending.append((future, suburl,
+                            href[1] if len(href) > 1 else '', i))
+            while pending and (pending[0][0] is None or
+                               len(pending) >= concurrency):
+                yield await nextdoc(*pending.popleft())
+        while pending:
+            yield await nextdoc(*pending.popleft())
+        complete = len(hrefs)  # 这个位置之前的子页面都完成了
+        for doc, suburl, i in failed:
+            html, error = await loop.run_in_executor(pool, getpage,
+                                                     suburl, encode)
+            if error is None:
+                page = htmltodoc(html, doc.name, title_re, line_re,
+                                 textengine)
+                doc.title = page.title or doc.title
+                doc.data = page.data
+                doc.complete = True
+                if journal:
+                    journal.record(suburl, doc)
+            else:
+                complete = min(complete, i)
+        if state is not None:
+            state['mark'] = hrefmark(hrefs[:complete]) if complete else ''
+    finally:
+        for future, suburl, title, i in pending:
+            if future is not None:
+                future.cancel()
+        pool.shutdown()
+        if journal:
+            journal.close()
+
+
+def _trypage(get):
+    """包装get(url, encode):返回(页面, None),下载失败时返回(None, 错误)"""
+    def tryget(url, encode):
+        try:
+            return get(url, encode), None
+        except OSError as e:
+            return None, e
+    return tryget
+
+
+def _synciter(agen):
+    """在一个新的事件循环中逐个取得异步迭代器agen的结果
+    迭代没有完成就被关闭时,agen也被关闭
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(agen.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(agen.aclose())
+        loop.close()
 
 
 def iter_txt(file,
@@ -252,7 +889,9 @@ def iter_txt(file,
              textengine=default_textengine,
              encode='utf-8',
              startline=1,
-             namegen=autoname()):
+             namegen=None,
+             mark='',
+             state=None):
     """从一个文本文件中枚举所有章节
     titlere: 用于识别章节名的正则表达式,匹配的行作为章节名,后续的行作为章节内容
     ignorebkline: 是否跳过空行,默认是不处理空行的
@@ -260,6 +899,13 @@ def iter_txt(file,
         默认的处理器是在<p>标记中以两个中文空格开始去掉左边全部空格的一行
     encode: 指出文件的编码格式
     startline: 文件开始若干行不参与处理,这个行数包括空行
+    mark: 上次生成时记录的续读标记(见state).文件只在末尾追加了内容时,标记位置
+        之前的章节已经生成过,它跳过这些章节(以及它们的名字),只分析此后的内容,
+        从上次的最后一个章节开始迭代.标记之前的内容有改变时,完全重新分析
+    state: 一个dict,给出它时记录续读标记,它通常就是createepub()的meta参数,
+        这样标记会保存在epub的source:mark中,recreate()据此只追加新的章节.
+        调用时state['mark']设为经过验证的mark(无效时为''),
+        迭代完毕后设为新的续读标记.编码与ascii不兼容时不记录标记,它总是''
     >>> file = 'C:/Users/hunte/Documents/baiduyun/阿瑟·C·克拉克/复原.TXT'
     >>> it = iter_txt(file, encode='gbk', startline=3)
     >>> for e in it:
@@ -272,6 +918,24 @@ def iter_txt(file,
     >>> type(it)
     <class 'generator'>
     """
+    if namegen is None:
+        namegen = autoname()
+    if state is None and not mark:
+        return _iter_lines(file, titlere, ignorebkline, textengine, encode,
+                           startline, namegen)
+    resumed = checkmark(file, mark)
+    if state is not None:
+        state['mark'] = mark if resumed else ''
+    if txtcodec(encode) is None:
+        return _iter_lines(file, titlere, ignorebkline, textengine, encode,
+                           startline, namegen)
+    return _iter_marked(file, titlere, ignorebkline, textengine, encode,
+                        startline, namegen, resumed, state)
+
+
+def _iter_lines(file, titlere, ignorebkline, textengine, encode, startline,
+                namegen):
+    """逐行读取文本文件来迭代章节,见iter_txt"""
     title_re = re.compile(titlere)
     new_doc = XhtmlDoc(next(namegen))
     with open(file, 'r', encoding=encode) as f:
@@ -288,7 +952,7 @@ def iter_txt(file,
                     new_doc = XhtmlDoc(next(namegen))
                 new_doc.title = line
             else:
-                new_doc.data += textengine(line) + '\n'
+                new_doc.append(textengine(line) + '\n')
     if new_doc.data != '':
         if new_doc.title == '':
             new_doc.title = os.path.basename(file)
@@ -297,9 +961,333 @@ def iter_txt(file,
         yield new_doc  # 迭代出最后一个文档
 
 
+_SCAN_BLOCK = 1 << 20  # 扫描文本文件时每次解码的字节数
+_re_nonblank = re.compile(rb'[^\r\n]')
+_re_flags = re.compile(r'\(\?[aiLmsux]+\)')
+
+
+def txtcodec(encode: str) -> str:
+    """得到按字节范围解码文本文件时使用的编码
+    只有与ascii兼容的编码(换行符总是单字节的b'\\n',也不会出现在多字节字符中)
+    才能按字节范围处理,其它的编码(如utf_16)返回None.
+    utf_8_sig按utf_8处理,文件开始的BOM在扫描时跳过
+    """
+    name = codecs.lookup(encode).name
+    if name == 'utf-8-sig':
+        return 'utf-8'
+    if '\n'.encode(name) == b'\n' and 'a'.encode(name) == b'a':
+        return name
+    return None
+
+
+def scantxt(file, titlere='^[^ ^　].*', ignorebkline=True,
+            encode='utf-8', startline=1):
+    """扫描文本文件,得到每个章节的标题与它的内容在文件中的字节范围
+    分章的规则与iter_txt相同.文件以mmap映射,每次解码一大块(以行结束),
+    用一个多行正则表达式在其中查找标题行,每个候选行再用titlere完整匹配确认.
+    返回(chapters, yieldlast):
+        chapters: [(title, [(start, end), ...]), ...]
+        yieldlast: 最后一个章节是否有内容,iter_txt不会迭代出没有内容的最后一个章节
+    """
+    return _scantxt(file, titlere, ignorebkline, encode, startline)[1:]
+
+
+def _scantxt(file, titlere, ignorebkline, encode, startline, offset=0):
+    """见scantxt,它另外返回找到的标题行[(标题, 标题行开始, 下一行开始), ...]
+    offset: 大于0时从这个位置(一行的开始)扫描,不再跳过BOM与startline
+    """
+    codec = txtcodec(encode)
+    title_re = re.compile(titlere)
+    flags = _re_flags.match(titlere)  # 全局标志只能放在最前面
+    flags = flags.group() if flags else ''
+    try:
+        finder = re.compile(r'{}^(?:{})\r?$'.format(
+            flags, titlere[len(flags):]), re.M)
+    except re.error:
+        finder = re.compile(r'^.*$', re.M)  # 不能组合时逐行确认
+    titles = []  # (标题, 标题行开始, 下一行开始)
+    with open(file, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return titles, [('', [])], False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = offset
+            if offset == 0:
+                if codecs.lookup(encode).name == 'utf-8-sig' and \
+                        mm[:3] == codecs.BOM_UTF8:
+                    pos = 3
+                for _ in range(startline - 1):
+                    nl = mm.find(b'\n', pos)
+                    pos = size if nl < 0 else nl + 1
+            start = pos
+            while pos < size:
+                end = min(pos + _SCAN_BLOCK, size)
+                if end < size:
+                    nl = mm.rfind(b'\n', pos, end)
+                    if nl < 0:
+                        nl = mm.find(b'\n', end)
+                    end = size if nl < 0 else nl + 1
+                text = mm[pos:end].decode(codec)
+                spos, bpos = 0, pos  # text中的位置spos对应文件中的位置bpos
+                found = finder.search(text)
+                while found:
+                    ls = found.start()
+                    le = text.find('\n', ls)
+                    nxt = len(text) if le < 0 else le + 1
+                    line = text[ls:nxt].rstrip('\n').rstrip('\r')
+                    if (line or not ignorebkline) and title_re.fullmatch(line):
+                        bpos += len(text[spos:ls].encode(codec))
+                        spos = ls
+                        titles.append((line, bpos,
+                                       bpos + len(text[ls:nxt].encode(codec))))
+                    if nxt >= len(text):
+                        break
+                    found = finder.search(text, nxt)
+                pos = end
+            if titles:
+                ranges = [(start, titles[0][1])]
+                chapters = []
+                for i, (title, _, body) in enumerate(titles):
+                    nxt = titles[i + 1][1] if i + 1 < len(titles) else size
+                    ranges.append((body, nxt))
+                    chapters.append((title, [r for r in ranges if r[0] < r[1]]))
+                    ranges = []
+            else:
+                chapters = [('', [(start, size)] if start < size else [])]
+            last = chapters[-1][1]
+            if ignorebkline:
+                yieldlast = any(_re_nonblank.search(mm, s, e) for s, e in last)
+            else:
+                yieldlast = len(last) > 0
+    return titles, chapters, yieldlast
+
+
+def readtxt(file, ranges, encode='utf-8', ignorebkline=True,
+            textengine=default_textengine) -> str:
+    """读出文本文件中一组字节范围的内容,每行由textengine处理"""
+    chunks = []
+    with open(file, 'rb') as f:
+        for start, end in ranges:
+            f.seek(start)
+            chunks.append(f.read(end - start))
+    text = b''.join(chunks).decode(encode)
+    if not text:
+        return ''
+    if text.endswith('\n'):
+        text = text[:-1]
+    return ''.join(textengine(line) + '\n'
+                   for line in (e.rstrip('\r') for e in text.split('\n'))
+                   if line or not ignorebkline)
+
+
+class TxtDoc(XhtmlDoc):
+    """内容在文本文件中的文档
+    它只记录内容在文件中的字节范围,在读取data(生成html)时才读出并解码,
+    修改data或append()后,它与普通的XhtmlDoc相同
+    source: readtxt()的参数(file, ranges, encode, ignorebkline, textengine)
+    """
+    __slots__ = ('_source',)
+
+    def __init__(self, filename: str = None, title: str = '', source=None):
+        super().__init__(filename, title)
+        self._source = source
+
+    @property
+    def data(self) -> str:
+        if self._source is not None:
+            return readtxt(*self._source)
+        return XhtmlDoc.data.fget(self)
+
+    @data.setter
+    def data(self, data: str):
+        self._source = None
+        XhtmlDoc.data.fset(self, data)
+
+    def append(self, s: str):
+        if self._source is not None:
+            self.data = self.data
+        super().append(s)
+
+
+class ArchivedDoc(XhtmlDoc):
+    """已经写入过epub的文档
+    archived: (大小, CRC),它在epub中的条目应有的大小与CRC.
+        EpubCreater写入它时,已有的epub文件中同名的条目大小与CRC都一致,
+        就原样复制那个条目,不需要再生成与压缩它的内容
+    loader: 生成内容的函数,只在需要读取data(比如已有的epub中没有这个条目)时
+        才被调用.它为None时,内容就是data
+    """
+    __slots__ = ('archived', '_loader')
+
+    def __init__(self, filename: str = None, title: str = '', data: str = '',
+                 parentsrc: str = '', archived=None, loader=None):
+        super().__init__(filename, title, data, parentsrc)
+        self.archived = archived
+        self._loader = loader
+
+    @property
+    def data(self) -> str:
+        if self._loader is not None:
+            self.data = self._loader()
+        return XhtmlDoc.data.fget(self)
+
+    @data.setter
+    def data(self, data: str):
+        self._loader = None
+        XhtmlDoc.data.fset(self, data)
+
+    def append(self, s: str):
+        if self._loader is not None:
+            self.data = self.data
+        super().append(s)
+
+
+def _loadindex(indexfile: str, stat, args: list):
+    """读出索引文件,它与文件的大小/修改时间及扫描参数一致时才有效"""
+    try:
+        with open(indexfile, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if index.get('size') != stat.st_size or \
+            index.get('mtime') != stat.st_mtime_ns or \
+            index.get('args') != args:
+        return None
+    return ([(title, [tuple(r) for r in ranges])
+             for title, ranges in index['chapters']],
+            index['yieldlast'])
+
+
+def _indexfile(file: str) -> str:
+    """file的索引文件名:同一目录中的.文件名.idx"""
+    head, tail = os.path.split(file)
+    return os.path.join(head, '.' + tail + '.idx')
+
+
+def _saveindex(indexfile: str, stat, args: list, chapters, yieldlast):
+    """保存索引文件,不能写入时(比如只读的目录)忽略它"""
+    _savejson(indexfile, {'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                          'args': args, 'chapters': chapters,
+                          'yieldlast': yieldlast})
+
+
+def iter_bigtxt(file,
+                titlere='^[^ ^　].*',
+                ignorebkline=True,
+                textengine=default_textengine,
+                encode='utf-8',
+                startline=1,
+                namegen=None,
+                index=True):
+    """从一个文本文件中枚举所有章节,它适用于很大的文件
+    参数与分章的规则都与iter_txt相同,迭代出的文档也相同,但是:
+    文件以mmap映射,章节标题用一个多行正则表达式在整块内容中查找,
+    而不是逐行匹配;迭代出的是TxtDoc,它只记录章节内容在文件中的字节范围,
+    在生成html时才读出并解码,因此内存占用与文件的大小无关.
+    index: 是否使用索引文件(与file同目录的.文件名.idx),它保存了各章节的
+        字节范围,文件的大小与修改时间以及分章参数都没有改变时,不需要再次扫描文件.
+        索引文件以.开头,eachfiles/iter_dir不会把它当作书的内容
+    编码与ascii不兼容(如utf_16)时,它使用iter_txt
+    """
+    if namegen is None:
+        namegen = autoname()
+    codec = txtcodec(encode)
+    if codec is None:
+        yield from iter_txt(file, titlere, ignorebkline, textengine,
+                            encode, startline, namegen)
+        return
+    stat = os.stat(file)
+    args = [titlere, ignorebkline, codecs.lookup(encode).name, startline]
+    indexfile = _indexfile(file)
+    found = _loadindex(indexfile, stat, args) if index else None
+    if found is None:
+        found = scantxt(file, titlere, ignorebkline, encode, startline)
+        if index:
+            _saveindex(indexfile, stat, args, *found)
+    yield from _iter_chapters(file, *found, codec, ignorebkline, textengine,
+                              namegen)
+
+
+def _iter_chapters(file, chapters, yieldlast, codec, ignorebkline, textengine,
+                   namegen):
+    """由scantxt()的结果迭代出各章节的TxtDoc"""
+    for i, (title, ranges) in enumerate(chapters):
+        name = next(namegen)
+        if i == len(chapters) - 1:
+            if not yieldlast:
+                break
+            if title == '':
+                title = os.path.basename(file)
+            if '.' in title:
+                title = title[0: title.rindex('.')]  # 与iter_txt一致
+        yield TxtDoc(name, title,
+                     (file, ranges, codec, ignorebkline, textengine))
+
+
+def _digest(file, end: int) -> str:
+    """文件开始end个字节的sha1"""
+    digest = hashlib.sha1()
+    with open(file, 'rb') as f:
+        while end > 0:
+            data = f.read(min(end, _SCAN_BLOCK))
+            if not data:
+                break
+            digest.update(data)
+            end -= len(data)
+    return digest.hexdigest()
+
+
+def checkmark(file, mark: str):
+    """验证iter_txt的续读标记
+    标记的格式为"文件大小:最后一个章节的开始:它的标题行之后:之前的章节数:校验和",
+    校验和是文件到最后一个章节的标题行为止的内容的sha1.
+    文件没有变小,并且校验和一致时,返回(最后一个章节的开始, 之前的章节数),
+    否则返回None
+    """
+    try:
+        size, offset, checked, count, digest = mark.split(':')
+        size, offset, checked, count = (int(size), int(offset),
+                                        int(checked), int(count))
+    except (AttributeError, ValueError):
+        return None
+    if offset <= 0 or not os.path.isfile(file) or \
+            os.path.getsize(file) < size or _digest(file, checked) != digest:
+        return None
+    return offset, count
+
+
+def _iter_marked(file, titlere, ignorebkline, textengine, encode, startline,
+                 namegen, resumed, state):
+    """以scantxt()分析文本文件来迭代章节,并记录续读标记,见iter_txt
+    resumed: checkmark()的结果,为None时分析整个文件
+    """
+    offset, count = resumed or (0, 0)
+    for _ in range(count):
+        next(namegen)  # 这些章节已经生成过了
+    size = os.path.getsize(file)
+    titles, chapters, yieldlast = _scantxt(file, titlere, ignorebkline,
+                                           encode, startline, offset)
+    yield from _iter_chapters(file, chapters, yieldlast, txtcodec(encode),
+                              ignorebkline, textengine, namegen)
+    if state is None:
+        return
+    if len(titles) > 1:
+        # 最后一个章节之前的章节都是完整的,下次从它开始
+        _, offset, checked = titles[-1]
+        count += len(titles) - 1
+    elif resumed is None:
+        state['mark'] = ''  # 还没有完整的章节
+        return
+    else:
+        checked = int(state['mark'].split(':')[2])
+    state['mark'] = '{}:{}:{}:{}:{}'.format(size, offset, checked, count,
+                                            _digest(file, checked))
+
+
 def iter_dir(homedir, exts='*', includesubdir=False, monoinfile=False,
              titlere='^[^ ^　].*', textengine=default_textengine,
-             encode=None):
+             encode=None, workers=1, window=None, processes=False,
+             manifest=''):
     """遍历目录中的文件来迭代每个文档
     对于符合exts的每个文件,它至少迭代出一个文档
     homedir: 要遍历的目录
@@ -311,104 +1299,333 @@ def iter_dir(homedir, exts='*', includesubdir=False, monoinfile=False,
     textengine: 行处理器
     encode: 文件编码
         如果明确知道这些文件的编码,请指定它,这会节省很多时间
-        如果包含的文件有多种编码,则不用指定,它会根据内容来判断文件编码
+        如果包含的文件有多种编码,则不用指定,它会根据内容来判断文件编码,
+        判断的结果缓存在每个目录的EncodeCache.filename中
+    workers: 处理文件(识别编码,读取与分章)的线程数,大于1时文件在一组工作线程中
+        并行处理,迭代出的文档及它们的顺序与逐个处理时完全相同
+    window: 同时处于处理中或等待迭代的文件数上限,默认为workers的2倍,
+        每个这样的文件的全部章节都在内存中
+    processes: 使用一组进程而不是线程来处理文件,分章是cpu密集的工作,
+        进程才能使用多个cpu;这时textengine需要可以被pickle(模块级的函数)
+    manifest: 清单文件(json),为''时不使用.
+        清单记录了每个文件的(大小, 修改时间, 内容的sha1)与由它生成的文档,
+        迭代完毕后更新.再次迭代时,与清单相比没有变化的文件不再读取与分章,
+        它的文档沿用原来的名字,以ArchivedDoc迭代出,
+        EpubCreater将它们从已有的epub中原样复制;目录文档也沿用原来的名字,
+        内容没有变化的同样原样复制.只有新增与改变了的文件使用新的文档名.
+        清单中的文件在已有的epub中找不到时,它们被重新处理,结果总是正确的
     """
-    homedir = homedir.replace(os.sep, os.altsep)
+    homedir = homedir.replace(os.sep, _ALTSEP)
+    start = len(os.path.join(homedir, ''))  # 清单中的路径相对于homedir
+    args = [exts, includesubdir, monoinfile, titlere, encode,
+            '{}.{}'.format(textengine.__module__, textengine.__qualname__)]
+    old = _loadmanifest(manifest, args) if manifest else None
+    if old is None:
+        old = {'next': [1, 1], 'dirs': {}, 'files': {}}
+    new = {'args': args, 'dirs': {}, 'files': {}}
     dirnames = {homedir: ''}
-    docsrc = autoname('Text/{}.xhtml')
-    dirsrc = autoname('Text/dir{}.xhtml')
+    docids = autoinc(old['next'][0])
+    dirids = autoinc(old['next'][1])
+    docsrc = ('Text/{}.xhtml'.format(i) for i in docids)
+    dirsrc = ('Text/dir{}.xhtml'.format(i) for i in dirids)
     li_fmt = '<li><a href="{}">{}</a></li>\n'
-    for file in eachfiles(homedir, exts, includesubdir):
-        dirname = os.path.dirname(file)
-        # 新目录的父节点可能也没有...直到homedir才确定有
-        # a已注册,a/b/c需要先注册a/b,才可以注册a/b/c
-        # 因此,可能需要迭代出多个dir_doc
-        new_dirs = []
-        parentname = dirname
-        while parentname not in dirnames:  # 列出所有未注册的上级目录
-            new_dirs.append(parentname)
-            parentname = os.path.dirname(parentname)
-        if len(new_dirs) > 0:  # 存在未注册的上级目录
-            new_dirs.reverse()
-            for each_dir in new_dirs:
-                dirnames[each_dir] = next(dirsrc)
-                yield dirtodoc(each_dir, dirnames)
-        # 文件编码,必要时通过内容识别
-        file_encode = encode
-        if file_encode is None:
-            file_encode = getfileencode(file)
-        if monoinfile:
-            # 文件内不分章节,整个文件只生成一个xhtmldoc
-            txt_doc = filetodoc(filename=file,
-                                encode=file_encode,
-                                textengine=textengine)
-            txt_doc.name = next(docsrc)
-            txt_doc.parentsrc = dirnames[dirname][5:]
-            yield txt_doc
+    reused = {}  # 与清单相比没有变化的文件 -> 清单中的记录
+
+    def unchanged(file):
+        entry = _unchanged(old['files'].get(file[start:]), file)
+        if entry is not None:
+            reused[file] = entry
+        return entry is not None
+    with EncodeCache() as encodes:
+        files = eachfiles(homedir, exts, includesubdir)
+        if workers > 1:
+            files = _iter_ingested(files, workers, window, processes, encodes,
+                                   monoinfile, titlere, textengine, encode,
+                                   unchanged if manifest else None)
         else:
-            # 文件内分章节
-            # 文件本身生成一个相应的的目录式文档(它是未决提交的)
-            file_src = next(dirsrc)
-            filedoc = XhtmlDoc(filename=file_src,
-                               title=juststem(file),
-                               data='<ui>\n',
-                               parentsrc=dirnames[dirname][5:],
-                               complete=False)
-            yield filedoc
-            for each_doc in iter_txt(file=file,
-                                     titlere=titlere,
-                                     textengine=textengine,
-                                     encode=file_encode,
-                                     namegen=docsrc):
-                each_doc.parentsrc = file_src[5:]
-                filedoc.data += li_fmt.format(each_doc.name[5:],
-                                              each_doc.title)
-                yield each_doc
-            filedoc.data += '</ui>\n'
-            filedoc.complete = True  # filedoc已经完成
+            files = ((file, None) for file in files)
+        for file, ingested in files:
+            dirname = os.path.dirname(file)
+            # 新目录的父节点可能也没有...直到homedir才确定有
+            # a已注册,a/b/c需要先注册a/b,才可以注册a/b/c
+            # 因此,可能需要迭代出多个dir_doc
+            new_dirs = []
+            parentname = dirname
+            while parentname not in dirnames:  # 列出所有未注册的上级目录
+                new_dirs.append(parentname)
+                parentname = os.path.dirname(parentname)
+            if len(new_dirs) > 0:  # 存在未注册的上级目录
+                new_dirs.reverse()
+                for each_dir in new_dirs:
+                    dirnames[each_dir] = old['dirs'].get(each_dir[start:]) \
+                        or next(dirsrc)
+                    dir_doc = dirtodoc(each_dir, dirnames)
+                    if manifest:
+                        new['dirs'][each_dir[start:]] = dir_doc.name
+                        dir_doc = _archive(dir_doc)
+                    yield dir_doc
+            entry = None
+            if manifest and ingested is None and \
+                    (workers > 1 or unchanged(file)):
+                entry = reused.pop(file, None)
+            if entry:
+                # 文件没有变化,沿用清单中的文档
+                new['files'][file[start:]] = entry
+                yield from _archiveddocs(file, entry, dirnames[dirname][5:],
+                                         monoinfile, titlere, textengine)
+                continue
+            if ingested is not None:
+                # 已经在工作线程中处理过了
+                file_encode = ingested[0]
+                docs = _ingesteddocs(ingested, docsrc)
+            else:
+                # 文件编码,必要时通过内容识别
+                file_encode = encode or encodes.getencode(file)
+                if monoinfile:
+                    txt_doc = filetodoc(filename=file, encode=file_encode,
+                                        textengine=textengine)
+                    txt_doc.name = next(docsrc)
+                    docs = [txt_doc]
+                else:
+                    docs = iter_txt(file=file,
+                                    titlere=titlere,
+                                    textengine=textengine,
+                                    encode=file_encode,
+                                    namegen=docsrc)
+            if manifest:
+                entry = _fileentry(file, file_encode)
+                new['files'][file[start:]] = entry
+            if monoinfile:
+                # 文件内不分章节,整个文件只生成一个xhtmldoc
+                for txt_doc in docs:
+                    txt_doc.parentsrc = dirnames[dirname][5:]
+                    if entry:
+                        entry['docs'].append(_docsum(txt_doc))
+                    yield txt_doc
+            else:
+                # 文件内分章节
+                # 文件本身生成一个相应的的目录式文档(它是未决提交的)
+                file_src = next(dirsrc)
+                filedoc = XhtmlDoc(filename=file_src,
+                                   title=juststem(file),
+                                   data='<ui>\n',
+                                   parentsrc=dirnames[dirname][5:],
+                                   complete=False)
+                yield filedoc
+                for each_doc in docs:
+                    each_doc.parentsrc = file_src[5:]
+                    filedoc.append(li_fmt.format(each_doc.name[5:],
+                                                 each_doc.title))
+                    if entry:
+                        entry['docs'].append(_docsum(each_doc))
+                    yield each_doc
+                filedoc.append('</ui>\n')
+                filedoc.complete = True  # filedoc已经完成
+                if entry:
+                    entry['index'] = file_src
+    if manifest:
+        new['next'] = [next(docids), next(dirids)]
+        _savejson(manifest, new)
+
+
+def _loadmanifest(manifest: str, args: list):
+    """读出iter_dir的清单,它的参数与args一致时才有效"""
+    try:
+        with open(manifest, 'r', encoding='utf-8') as f:
+            found = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if found.get('args') != args:
+        return None
+    return found
+
+
+def _fileentry(file, encode: str) -> dict:
+    """为file建立清单中的记录,由它生成的文档随后加入其中"""
+    stat = os.stat(file)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+            'sha1': _digest(file, stat.st_size), 'encode': encode,
+            'index': None, 'docs': []}
+
+
+def _unchanged(entry, file):
+    """file与清单中的记录entry相比没有变化时返回entry,否则返回None
+    大小与修改时间都一致就认为没有变化;只有修改时间不同时再比较内容的sha1,
+    内容相同则只更新记录中的修改时间
+    """
+    if entry is None:
+        return None
+    try:
+        stat = os.stat(file)
+    except OSError:
+        return None
+    if entry['size'] != stat.st_size:
+        return None
+    if entry['mtime'] != stat.st_mtime_ns:
+        if entry['sha1'] != _digest(file, stat.st_size):
+            return None
+        entry['mtime'] = stat.st_mtime_ns
+    return entry
+
+
+def _docsum(doc) -> list:
+    """清单中文档的记录:[名字, 标题, 大小, CRC]"""
+    data = doc.encoded
+    return [doc.name, doc.title, len(data), zlib.crc32(data)]
+
+
+def _archive(doc) -> ArchivedDoc:
+    """将内容已经确定的doc转为ArchivedDoc,已有的epub中同样的条目可以原样复制"""
+    doc = ArchivedDoc(doc.name, doc.title, doc.data, doc.parentsrc)
+    doc.archived = tuple(_docsum(doc)[2:])
+    return doc
+
+
+def _archiveddocs(file, entry, parentsrc, monoinfile, titlere, textengine):
+    """由清单中的记录迭代出没有变化的文件的文档
+    章节的内容只在已有的epub中找不到它们时才重新读取,file最多读取一次
+    """
+    loaded = []
+
+    def load(index):
+        if not loaded:
+            ingested = _ingestfile(file, monoinfile, titlere, textengine,
+                                   entry['encode'], 0)
+            loaded.extend(data for _, _, data in ingested[3])
+        return loaded[index]
+    li_fmt = '<li><a href="{}">{}</a></li>\n'
+    if not monoinfile:
+        yield _archive(XhtmlDoc(
+            filename=entry['index'], title=juststem(file),
+            data=''.join(['<ui>\n'] +
+                         [li_fmt.format(name[5:], title)
+                          for name, title, _, _ in entry['docs']] +
+                         ['</ui>\n']),
+            parentsrc=parentsrc))
+        parentsrc = entry['index'][5:]
+    for index, (name, title, size, crc) in enumerate(entry['docs']):
+        yield ArchivedDoc(name, title, parentsrc=parentsrc,
+                          archived=(size, crc),
+                          loader=lambda index=index: load(index))
+
+
+def _ingestfile(file, monoinfile, titlere, textengine, encode, threshold):
+    """在工作线程(或进程)中处理iter_dir的一个文件:识别编码,读取与分章
+    encode为None时识别文件的编码
+    返回(编码, 可信度, 用掉的文档名数, [(文档名的序号, 标题, 内容), ...]),
+    可信度为None表示编码不是识别得到的.
+    文档名与逐个处理时一样地分配:iter_txt没有迭代出最后一个空的章节时,
+    这个章节的名字也已经用掉了
+    """
+    confidence = None
+    if encode is None:
+        encode, confidence = fileencode(file, threshold)
+    if monoinfile:
+        doc = filetodoc(filename=file, encode=encode, textengine=textengine)
+        return encode, confidence, 1, [(0, doc.title, doc.data)]
+    names = autoname('{}')
+    docs = [(int(doc.name) - 1, doc.title, doc.data)
+            for doc in iter_txt(file=file, titlere=titlere,
+                                textengine=textengine, encode=encode,
+                                namegen=names)]
+    return encode, confidence, int(next(names)) - 1, docs
+
+
+def _ingesteddocs(ingested, namegen):
+    """由_ingestfile()的结果建立文档,它们的名字取自namegen"""
+    _, _, count, docs = ingested
+    names = [next(namegen) for _ in range(count)]
+    for index, title, data in docs:
+        yield XhtmlDoc(names[index], title, data)
+
+
+def _iter_ingested(files, workers, window, processes, encodes,
+                   monoinfile, titlere, textengine, encode, skip=None):
+    """在一组工作线程(或进程)中以_ingestfile()处理files中的文件,
+    按files的顺序迭代出(文件, 处理的结果)
+    最多window个文件处于处理中或等待迭代的状态,以限制内存占用.
+    识别编码前先查找encodes中的缓存,识别的结果再记录到其中
+    skip(file)为True的文件不需要处理,它的结果为None
+    """
+    window = window or workers * 2
+    executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    pending = deque()
+
+    def done():
+        file, future = pending.popleft()
+        if future is None:
+            return file, None
+        ingested = future.result()
+        if ingested[1] is not None:
+            encodes.record(file, ingested[0], ingested[1])
+        return file, ingested
+    with executor(workers) as pool:
+        try:
+            for file in files:
+                if skip is not None and skip(file):
+                    pending.append((file, None))
+                    continue
+                code = encode if encode is not None else encodes.lookup(file)
+                pending.append((file, pool.submit(
+                    _ingestfile, file, monoinfile, titlere, textengine,
+                    code, encodes.threshold)))
+                while pending and (pending[0][1] is None or
+                                   pending[0][1].done() or
+                                   len(pending) >= window):
+                    yield done()
+            while pending:
+                yield done()
+        finally:
+            for _, future in pending:
+                if future is not None:
+                    future.cancel()
 
 
 def iter_files(files: list,
                titlere=None,
                textengine=default_textengine,
                encode=None,
-               namegen=autoname()):
+               namegen=None):
     """从一组文件中迭代
     titlere: 章节标题识别使用的正则式
         如果不指定,则每个文件生成一个文档,它使用文件的根名作为标题
         如果指定则以文件名下含章节来构成多层导航
     textengine: 内容行处理器
     encode: 文件使用的编码
-        若不指定则自动识别,但这会增加额外的处理时间并且不一定正确
+        若不指定则自动识别,但这会增加额外的处理时间并且不一定正确,
+        识别的结果缓存在每个目录的EncodeCache.filename中
     """
+    if namegen is None:
+        namegen = autoname()
     li_fmt = '<li><a href="{}">{}</a></li>\n'
-    for file in files:
-        file_encode = encode
-        if file_encode is None:  # 文件编码识别
-            file_encode = getfileencode(file)
-        if titlere:  # 文件内分章节
-            file_doc = XhtmlDoc(filename=next(namegen),
-                                title=juststem(file),
-                                data='<ui>\n',
-                                complete=False)
-            yield file_doc  # 文档是未决的
-            for each_doc in iter_txt(file=file,
-                                     titlere=titlere,
-                                     textengine=textengine,
-                                     encode=file_encode,
-                                     namegen=namegen):
-                file_doc.data += li_fmt.format(each_doc.name,
-                                               each_doc.title)
-                each_doc.parentsrc = file_doc.name
-                yield each_doc
-            file_doc.data += '</ui>\n'
-            file_doc.complete = True
-        else:  # 文件内不分章节
-            txt_doc = filetodoc(filename=file,
-                                encode=file_encode,
-                                textengine=textengine)
-            txt_doc.name = next(namegen)
-            yield txt_doc
+    with EncodeCache() as encodes:
+        for file in files:
+            file_encode = encode
+            if file_encode is None:  # 文件编码识别
+                file_encode = encodes.getencode(file)
+            if titlere:  # 文件内分章节
+                file_doc = XhtmlDoc(filename=next(namegen),
+                                    title=juststem(file),
+                                    data='<ui>\n',
+                                    complete=False)
+                yield file_doc  # 文档是未决的
+                for each_doc in iter_txt(file=file,
+                                         titlere=titlere,
+                                         textengine=textengine,
+                                         encode=file_encode,
+                                         namegen=namegen):
+                    file_doc.append(li_fmt.format(each_doc.name,
+                                                  each_doc.title))
+                    each_doc.parentsrc = file_doc.name
+                    yield each_doc
+                file_doc.append('</ui>\n')
+                file_doc.complete = True
+            else:  # 文件内不分章节
+                txt_doc = filetodoc(filename=file,
+                                    encode=file_encode,
+                                    textengine=textengine)
+                txt_doc.name = next(namegen)
+                yield txt_doc
 
 
 if __name__ == '__main__':
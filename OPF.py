@@ -3,7 +3,9 @@
 
 from collections import Iterable
 import re
+import tempfile
 from enum import Enum
+from itertools import count
 from errors import *
 
 _F_XHTML = '''\
@@ -36,21 +38,38 @@ _DublinCoreNames = ('title',
                     'rights')
 
 
+_re_idchars = re.compile(r'[\w\d\-._:]+')
+_re_xname = re.compile('_x([\da-fA-F]{2})')
+_xmlnames = {}  # 已解码的属性名
+
+
 def hrefid(href: str) -> str:
-    """通过href中计算一个固定的id"""
-    href += '#'
-    return ''.join(re.compile(r'[\w\d\-._:]+').findall(href.split('#')[0]))
+    """通过href中计算一个固定的id
+    当计算结果与href相同时,返回的就是href本身,而不是一个新的字符串
+    """
+    path = href.split('#')[0]
+    hid = ''.join(_re_idchars.findall(path))
+    return href if hid == href else hid
 
 
 def displayedname(name: str) -> str:
     """对名称做解码(_x??转化为相应字符)
     name: 需要做解码的名称
     """
-    for s_16 in set(re.compile('_x([\da-fA-F]{2})').findall(name)):
+    for s_16 in set(_re_xname.findall(name)):
         name = name.replace('_x' + s_16, chr(int(s_16, 16)))
     return name
 
 
+def _xmlname(name: str) -> str:
+    """displayedname()的缓存版本,每个属性名只解码一次"""
+    try:
+        return _xmlnames[name]
+    except KeyError:
+        _xmlnames[name] = displayedname(name)
+        return _xmlnames[name]
+
+
 def lineidentity(s: str, step: int = 2) -> str:
     """将一个字符串每一行缩进指定空格"""
 
@@ -58,6 +77,29 @@ def lineidentity(s: str, step: int = 2) -> str:
     return '\n'.join(fmt.format(e) for e in s.split('\n'))
 
 
+def _indentlines(s: str, prefix: str) -> str:
+    """在s的每一行前添加prefix"""
+    return prefix + s.replace('\n', '\n' + prefix)
+
+
+def writechunks(fp, chunks: Iterable, encoding: str = 'utf-8',
+                bufsize: int = 65536):
+    """将一组字符串以encoding编码写入二进制文件对象fp
+    字符串积累到bufsize个字符后才做一次编码与写入,以避免过于零碎的写操作
+    """
+    buf = []
+    size = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        size += len(chunk)
+        if size >= bufsize:
+            fp.write(''.join(buf).encode(encoding))
+            buf = []
+            size = 0
+    if buf:
+        fp.write(''.join(buf).encode(encoding))
+
+
 class CoreMediaType(Enum):
     """OPF核心媒体类型
     在必要的时候(如建立spine(导航/目录)前应当确认它们的实际类型
@@ -75,35 +117,218 @@ class CoreMediaType(Enum):
     dtbncx = 'application/x-dtbncx+xml'
 
 
+_CoreMediaTypes = [e.value for e in CoreMediaType]
+_SpineMediaTypes = [CoreMediaType.xhtml.value,
+                    CoreMediaType.dtbook.value,
+                    CoreMediaType.oeb1doc.value]
+
+
+class Spool(object):
+    """未决文档的暂存区
+    多个文档共用一个临时文件.附加到暂存区的文档在内存中缓存追加的内容,
+    所有文档缓存的内容总量超过limit时,它们缓存的内容都被写入临时文件,
+    因此内存中缓存的内容总量不会超过limit(加上一次追加的内容).
+    limit: 内存中缓存的内容总量上限(字符数)
+    buffered: 当前内存中缓存的内容总量
+    peak: buffered曾经达到的最大值
+    spooled: 写入临时文件的内容总量
+    """
+
+    def __init__(self, limit: int = 1 << 20):
+        self.limit = limit
+        self.buffered = 0
+        self.peak = 0
+        self.spooled = 0
+        self._file = None
+        self._docs = set()  # 附加到暂存区的文档
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def grow(self, size: int) -> bool:
+        """记录缓存内容增加了size,返回是否超过了上限"""
+        self.buffered += size
+        self.peak = max(self.peak, self.buffered)
+        return self.buffered > self.limit
+
+    def spill(self):
+        """将所有附加的文档在内存中缓存的内容写入临时文件"""
+        for doc in self._docs:
+            doc._flush()
+
+    def write(self, s: str) -> tuple:
+        """将s写入临时文件,返回它的位置(offset, size)"""
+        if self._file is None:
+            self._file = tempfile.TemporaryFile()
+        data = s.encode('utf-8')
+        self._file.seek(0, 2)
+        offset = self._file.tell()
+        self._file.write(data)
+        self.spooled += len(s)
+        return offset, len(data)
+
+    def read(self, segments: list) -> str:
+        """读出write()写入的一组内容并按顺序连接"""
+        chunks = []
+        for offset, size in segments:
+            self._file.seek(offset)
+            chunks.append(self._file.read(size))
+        return b''.join(chunks).decode('utf-8')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
 class XhtmlDoc(object):
     """一个xhtml文档
     给出title与<body>中的内容即可通过html属性得到相应的xhtml文档内容
     name: 它写入到epub(zip)时的文件名,相对于OEBPS目录
     title: 文档标题,它用于构建相应的xhtml
     data: 文档的内容,它用于构建相应的xhtml
+        逐步构建内容时应当使用append(),它只追加片断,在读取data时才连接它们
     parentsrc: 文档在导航(nav)中上层的文档名,如果它是顶层的,则为''
     complete: 文档是完成态.如果文档未完成则置它为False
     translator: 翻译器.如果data不是html块,可以指定相应的翻译器将它翻译为html块
         翻译器应当是一个函数,接受一个字符串并返回等价的html块
+    html/encoded只在第一次访问时生成,之后直接使用保存的结果,
+    修改title/data/translator或append()时保存的结果失效.
+    保存的结果只有一份:访问html时保存str,访问encoded时保存编码后的bytes
+    逐步构建内容时,append()/extend()追加的片断每积累blocksize个就合并为一块,
+    因此构建内容的时间与内容的长度成线性关系,也不会保留大量零碎的字符串对象
     """
+    __slots__ = ('name', '_title', '_chunks', '_tail', '_spool', '_segments',
+                 'parentsrc', 'complete', '_translator', '_rendered')
+    blocksize = 1024  # 合并片断的数量
 
     def __init__(self, filename: str = None, title: str = '',
                  data: str = '', parentsrc: str = '',
                  complete=True, translator=None):
         self.name = filename
-        self.title = title
-        self.data = data
+        self._title = title
+        self._chunks = [data]  # 内存中的内容片断
+        self._tail = 0  # _chunks中这个位置之前的片断已经合并过了
+        self._spool = None  # 附加的暂存区
+        self._segments = []  # 已经写入暂存区的内容
         self.parentsrc = parentsrc
         self.complete = complete
-        self.translator = translator
+        self._translator = translator
+        self._rendered = None  # 保存的html(str)或encoded(bytes)
+
+    @property
+    def title(self) -> str:
+        return self._title
+
+    @title.setter
+    def title(self, title: str):
+        self._title = title
+        self._rendered = None
+
+    @property
+    def translator(self):
+        return self._translator
+
+    @translator.setter
+    def translator(self, translator):
+        self._translator = translator
+        self._rendered = None
 
     @property
-    def html(self):
-        if self.translator:
-            data = self.translator(self.data)
+    def data(self) -> str:
+        if len(self._chunks) != 1:
+            self._chunks = [''.join(self._chunks)]
+            self._tail = 0
+        if self._segments:
+            return self._spool.read(self._segments) + self._chunks[0]
+        return self._chunks[0]
+
+    @data.setter
+    def data(self, data: str):
+        self._rendered = None
+        if self._spool is not None:
+            self._spool.buffered -= self._buffered()
+            self._segments = []
+        self._chunks = [data]
+        self._tail = 0
+        if self._spool is not None and self._spool.grow(len(data)):
+            self._spool.spill()
+
+    def _buffered(self) -> int:
+        """内存中缓存的内容的字符数"""
+        return sum(len(chunk) for chunk in self._chunks)
+
+    def _flush(self):
+        """将内存中缓存的内容写入暂存区"""
+        size = self._buffered()
+        if size:
+            self._spool.buffered -= size
+            self._segments.append(self._spool.write(''.join(self._chunks)))
+            self._chunks = ['']
+            self._tail = 0
+
+    def append(self, s: str):
+        """向内容追加一段html块
+        附加到暂存区时,如果所有文档缓存的内容超过了暂存区的上限,
+        它们缓存的内容都将写入暂存区的临时文件
+        """
+        self._chunks.append(s)
+        self._rendered = None
+        if len(self._chunks) - self._tail > self.blocksize:
+            self._chunks[self._tail:] = [''.join(self._chunks[self._tail:])]
+            self._tail += 1
+        if self._spool is not None and self._spool.grow(len(s)):
+            self._spool.spill()
+
+    def extend(self, fragments):
+        """依次追加一组html块"""
+        for s in fragments:
+            self.append(s)
+
+    def spoolto(self, spool: Spool):
+        """附加到暂存区spool,此后追加的内容可能被写入它的临时文件"""
+        if self._spool is None:
+            self._spool = spool
+            spool._docs.add(self)
+            if spool.grow(self._buffered()):
+                spool.spill()
+
+    def unspool(self):
+        """将暂存区中的内容读回内存,并与暂存区分离"""
+        if self._spool is not None:
+            self._spool.buffered -= self._buffered()
+            self._spool._docs.discard(self)
+            data = self.data
+            self._spool = None
+            self._segments = []
+            self._chunks = [data]
+            self._tail = 0
+
+    def _render(self) -> str:
+        if self._translator:
+            data = self._translator(self.data)
         else:
             data = self.data
-        return _F_XHTML.format(title=self.title, data=data)
+        return _F_XHTML.format(title=self._title, data=data)
+
+    @property
+    def html(self) -> str:
+        """完整的xhtml文档内容"""
+        if self._rendered is None:
+            self._rendered = self._render()
+        elif isinstance(self._rendered, bytes):
+            return self._rendered.decode('utf-8')
+        return self._rendered
+
+    @property
+    def encoded(self) -> bytes:
+        """以utf-8编码的完整xhtml文档内容,它用于写入到epub中"""
+        if not isinstance(self._rendered, bytes):
+            self._rendered = (self._rendered or self._render()).encode('utf-8')
+        return self._rendered
 
 
 class _XML(list):
@@ -123,70 +348,101 @@ class _XML(list):
       <dc:identifier id="Bookid">978-7-5399-6291-7</dc:identifier>
     </metadata>
     """
-    name = ''
-    _value = None
-    args = {}
+    __slots__ = ('name', '_value', 'args')
+    _fields = frozenset(__slots__)  # 所有槽位的名称,派生类中自动扩充
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._fields = cls._fields.union(cls.__dict__.get('__slots__', ()))
 
     def __init__(self, node_name: str, node_value=None, **args):
         super().__init__()
         self.name = node_name
         self._value = node_value
-        self.args = args
+        self.args = args or None
 
     def __getattr__(self, attr):
+        """只有在槽位与类中都找不到attr时才会被调用
+        args:扩展属性,它们在输出xml时作为元素的属性
+            扩展属性可以在初始化时使用命名参数指定,不存在的扩展属性值为None
         """
-        value:保存在_value,它是xml元素对中间包含的值,只能通过初始化时指定
-            扩展属性value可以在初始化时使用命名参数指定:value='aaa'
-        """
-        if attr == 'value':
-            return self._value
-        else:
-            try:
-                return self.args[attr]
-            except (KeyError, ):
-                return None
+        if attr in self._fields or self.args is None:
+            return None
+        return self.args.get(attr)
 
     def __setattr__(self, attr, value):
-        if hasattr(self, attr):
+        if attr in self._fields or hasattr(type(self), attr):
             super().__setattr__(attr, value)
-        elif attr == 'value':
-            self._value = value
+        elif self.args is None:
+            self.args = {attr: value}
         else:
             self.args[attr] = value
 
+    @property
+    def value(self):
+        """xml元素对中间包含的值"""
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+
+    def iterattrs(self):
+        """逐个生成xml属性的(名称, 值),名称是已解码的"""
+        if self.args:
+            for k, v in self.args.items():
+                if k is not None:
+                    yield _xmlname(k), v
+
     @property
     def propertyxml(self):
         """返回xml的属性描述段
         未对属性名与值做合法性验证及处理
         """
         xml = ''
-        for k, v in self.args.items():
-            if k is not None:
-                k = displayedname(k)
-                if hasattr(v, '__call__'):
-                    # 后期计算的值
-                    v = v()
-                if v is None:
-                    v = ''
-                xml += ' {}="{}"'.format(k, v)
+        for k, v in self.iterattrs():
+            if hasattr(v, '__call__'):
+                # 后期计算的值
+                v = v()
+            if v is None:
+                v = ''
+            xml += ' {}="{}"'.format(k, v)
         return xml
 
-    @property
-    def xml(self):
-        """返回对象的xml
+    def iterxml(self, level: int = 0):
+        """逐段生成对象的xml,它们连接起来就是缩进了level层的xml
+        每层缩进两个空格,与对xml做level次lineidentity()的结果一致.
+        它不会先生成子元素的xml串再对它们做缩进,因此对于很大的结构,
+        可以用它(或writexml)来输出,而不必在内存中保留完整的xml串
         属性串先于元素生成
         """
+        prefix = '  ' * level
         xml_attr = self.propertyxml
         if len(self) > 0:
-            element = lineidentity('\n'.join(e.xml for e in self))
-            text = '\n{}\n'.format(element)
+            yield _indentlines('<{}{}>'.format(self.name, xml_attr), prefix)
+            for e in self:
+                yield '\n'
+                yield from e.iterxml(level + 1)
+            yield '\n{}</{}>'.format(prefix, self.name)
         else:
             text = self._value
-        if text is None:
-            fmt = '<{name}{attr} />'
-        else:
-            fmt = '<{name}{attr}>{text}</{name}>'
-        return fmt.format(name=self.name, attr=xml_attr, text=text)
+            if text is None:
+                fmt = '<{name}{attr} />'
+            else:
+                fmt = '<{name}{attr}>{text}</{name}>'
+            xml = fmt.format(name=self.name, attr=xml_attr, text=text)
+            yield _indentlines(xml, prefix)
+
+    def writexml(self, fp, level: int = 0, encoding: str = 'utf-8'):
+        """将缩进了level层的xml以encoding编码逐段写入二进制文件对象fp
+        fp可以是任何有write方法的对象,如ZipFile.open(name, 'w')
+        """
+        writechunks(fp, self.iterxml(level), encoding)
+
+    @property
+    def xml(self):
+        """返回对象的xml"""
+        return ''.join(self.iterxml())
 
 
 class MetaItem(_XML):
@@ -194,6 +450,7 @@ class MetaItem(_XML):
     dc-metadata可以不指定value,可以添加属性
     x-metadata必须指定value,且忽略添加的属性
     """
+    __slots__ = ()
 
     def __init__(self, node_name, node_value=None, **args):
         if node_name in _DublinCoreNames:
@@ -215,6 +472,7 @@ class Metadata(_XML):
     可以向Metadata实例添加一个MetaItem实例
     可以通过指定MetaItem名/值及基属性名/值向Metadata实例添加一个MetaItem实例
     """
+    __slots__ = ()
 
     def __init__(self, datas: Iterable = None):
         """可以在实例化时添加元素:self
@@ -255,6 +513,7 @@ class ManifestItem(_XML):
     它不要求属性的内容满足OPF规范的要求
     href不允许包含片断标示符,因此"#"及其后续部分将被丢弃(如果有的话)
     """
+    __slots__ = ()
 
     def __init__(self, href: str, media_x2dtype: CoreMediaType = None, **args):
         if '#' in href:
@@ -268,10 +527,121 @@ class ManifestItem(_XML):
         super().__init__('item', **args)
 
 
-class Mainfest(_XML):
+class _IndexedXML(_XML):
+    """为子项按属性建立散列索引的_XML
+    索引随列表内容的添加/插入/替换/删除同步维护,按属性值查找子项只需O(1)
+    _indexkeys: 需要建立索引的属性名
+    当多个子项的属性值相同时,索引指向其中最先加入的那一个
+    * 子项加入后再修改它被索引的属性值,索引不会随之更新
+    """
+    __slots__ = ('_index', '_shared')
+    _indexkeys = ()
+
+    def __init__(self, node_name: str, node_value=None, **args):
+        super().__init__(node_name, node_value, **args)
+        self._index = {key: {} for key in self._indexkeys}
+        self._shared = set()  # 出现过重复值的(属性名,属性值)
+
+    def lookup(self, key: str, value):
+        """寻找属性key的值为value的元素,没有时返回None"""
+        return self._index[key].get(value)
+
+    def _addindex(self, item):
+        for key in self._indexkeys:
+            value = getattr(item, key)
+            index = self._index[key]
+            if value in index:
+                self._shared.add((key, value))
+            else:
+                index[value] = item
+
+    def _delindex(self, item):
+        """在item从列表中移除之后调用,使索引指向剩余的同值元素(如果有的话)"""
+        for key in self._indexkeys:
+            value = getattr(item, key)
+            index = self._index[key]
+            if index.get(value) is not item:
+                continue
+            del index[value]
+            if (key, value) in self._shared:
+                for e in self:
+                    if getattr(e, key) == value:
+                        index[value] = e
+                        break
+                else:
+                    self._shared.discard((key, value))
+
+    def _reindex(self):
+        for index in self._index.values():
+            index.clear()
+        self._shared.clear()
+        for item in self:
+            self._addindex(item)
+
+    def append(self, item):
+        super().append(item)
+        self._addindex(item)
+
+    def insert(self, index, item):
+        super().insert(index, item)
+        for key in self._indexkeys:
+            value = getattr(item, key)
+            if value in self._index[key]:
+                # 插入位置可能在已有的同值元素之前,需要重新确定最先的一个
+                self._shared.add((key, value))
+                self._index[key][value] = next(
+                    e for e in self if getattr(e, key) == value)
+            else:
+                self._index[key][value] = item
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def remove(self, item):
+        super().remove(item)
+        self._delindex(item)
+
+    def pop(self, index=-1):
+        item = super().pop(index)
+        self._delindex(item)
+        return item
+
+    def clear(self):
+        super().clear()
+        self._reindex()
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            super().__setitem__(index, value)
+            self._reindex()
+        else:
+            old = self[index]
+            super().__setitem__(index, value)
+            self._delindex(old)
+            self._addindex(value)
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            super().__delitem__(index)
+            self._reindex()
+        else:
+            item = self[index]
+            super().__delitem__(index)
+            self._delindex(item)
+
+
+class Mainfest(_IndexedXML):
     """文件清单
     每个项均为一个ManifestItem实例
+    以id与href对各项建立了索引,查找与候选链检查的代价与清单的长度无关
     """
+    __slots__ = ()
+    _indexkeys = ('id', 'href')
 
     def __init__(self):
         super().__init__('manifest')
@@ -285,15 +655,11 @@ class Mainfest(_XML):
 
     def lookupid(self, findid: str) -> ManifestItem:
         """寻找指定id的元素"""
-        for maniitem in self:
-            if maniitem.id == findid:
-                return maniitem
+        return self._index['id'].get(findid)
 
     def lookuphref(self, href: str) -> ManifestItem:
         """寻找指定href的元素"""
-        for maniitem in self:
-            if maniitem.href == href:
-                return maniitem
+        return self._index['href'].get(href)
 
     def checkfillback(self,
                       maniitem: ManifestItem,
@@ -309,65 +675,78 @@ class Mainfest(_XML):
                 [CoreMediaType.xhtml,  ...]
         """
         if checklist is None or len(checklist) == 0:
-            checklist = [e.value for e in CoreMediaType]
+            checklist = _CoreMediaTypes
         hrefs = [maniitem.href]
         if maniitem.fallback:
+            visited = {maniitem.href}
             backer = self.lookupid(maniitem.fallback)
-            while backer.media_type not in checklist:
+            if backer is None:
+                raise EndToEmpty(hrefs)
+            while backer.media_x2dtype not in checklist:
                 hrefs.append(backer.href)
-                if backer.href in hrefs[:-1]:
+                if backer.href in visited:
                     raise CircularReference(hrefs)
-                if not hasattr(backer, 'fallback'):
+                visited.add(backer.href)
+                if backer.fallback is None:
                     raise EndNotCMT(hrefs)
                 backer = self.lookupid(backer.fallback)
                 if backer is None:
                     raise EndToEmpty(hrefs)
         elif maniitem.media_x2dtype not in checklist:
             hrefs.append(maniitem.media_x2dtype)
-            raise EndNotCMT(hrefs + checklist)
+            raise EndNotCMT(hrefs + list(checklist))
 
 
 class SpineItem(_XML):
     """书脊项
     linear默认为yes,不指定或指定为yes/no之外的内容时将处理为"yes"
+    idref与linear保存在槽位中,而不是扩展属性中
     """
+    __slots__ = ('idref', 'linear')
 
     def __init__(self, idref: str, linear: str = 'yes'):
         if linear not in ('yes', 'no'):
             linear = 'yes'
-        super().__init__('itemref', idref=idref, linear=linear)
+        super().__init__('itemref')
+        self.idref = idref
+        self.linear = linear
+
+    def iterattrs(self):
+        yield 'idref', self.idref
+        yield 'linear', self.linear
+        yield from super().iterattrs()
 
 
-class Spine(_XML):
+class Spine(_IndexedXML):
     """书脊
     书脊决定了文档的阅读顺序,它包含的每一项的顺序很重要
     它通过idref引用ManifestItem.id,书脊中每一个项的idref不能重复
     对应的ManifestItem应当满足下列条件之一:
         media_type是xhtml/dtbook/oeb1doc之一
         fillback链结束于xhtml/dtbook/oeb1doc之一
+    以idref对各项建立了索引,重复检查的代价与书脊的长度无关
     """
-    mainfest = None
+    __slots__ = ('mainfest',)
+    _indexkeys = ('idref',)
 
     def __init__(self, mainfest: Mainfest = None):
         super().__init__('spine', toc='ncx')
         if isinstance(mainfest, Mainfest):
             self.mainfest = mainfest
+        else:
+            self.mainfest = None
 
     def append(self, href: str):
         if self.mainfest:
             maniitem = self.mainfest.lookuphref(href)
             if maniitem is None:
                 raise QuotedNothing(href)
-            types = [CoreMediaType.xhtml.value,
-                     CoreMediaType.dtbook.value,
-                     CoreMediaType.oeb1doc.value]
-            self.mainfest.checkfillback(maniitem, types)
+            self.mainfest.checkfillback(maniitem, _SpineMediaTypes)
             idref = maniitem.id
         else:
             idref = hrefid(href)
-        for e in self:
-            if e.idref == idref:
-                raise QuotedRepeat(idref)
+        if idref in self._index['idref']:
+            raise QuotedRepeat(idref)
         super().append(SpineItem(idref))
 
 
@@ -375,29 +754,132 @@ class NavPoint(_XML):
     """Navigation Center eXtended,即目录
     ncx具备多层结构,顺序(order)是重要的
     src允许使用片断标示符#...来指向某个文档中特定位置
+    每个节点记录它的上层节点(_parent)与以它为顶的子树层数(_height),
+    子树层数在添加/插入/替换/删除子节点时逐层向上更新,
+    因此depth不需要遍历整个结构
+    导航文字(label)与目标(src)保存在槽位中,navLabel/content元素在输出xml时
+    才生成,列表中只包含下层的NavPoint.
+    * 注意,这与以前的版本不同:以前列表的前两项是navLabel与content元素,
+    因此len()与遍历的结果都少了这两项,请使用label/src属性
+    playOrder在输出xml时由一个只属于这次输出的计数器按顺序分配,
+    因此同时输出多个结构(比如在多个线程中)不会互相干扰
     """
-    __order = 0
-    _src = ''
+    __slots__ = ('id', 'label', 'src', '_parent', '_height')
+    _order = 0  # nextorder的计数器
 
     def __init__(self, label='', src=''):
-        super().__init__('navPoint',
-                         id=hrefid(src),
-                         playOrder=lambda: NavPoint.nextorder())
-        self._src = src
-        node = _XML('navLabel')
-        node.append(_XML('text', label))
-        super().append(node)
-        super().append(_XML('content', src=src))
+        super().__init__('navPoint')
+        self.id = hrefid(src)
+        self.label = label
+        self.src = src
+        self._parent = None
+        self._height = 1
 
     def append(self, navpoint: object, *path):
-        if not isinstance(navpoint, NavPoint):
-            raise TypeError('\'navpoint\' object is not NavPoint')
         if len(path) == 0:
+            self._check(navpoint)
             super().append(navpoint)
+            self._attach(navpoint)
         else:
             node = self.getnode(*path)
             node.append(navpoint)
 
+    def insert(self, index, navpoint):
+        self._check(navpoint)
+        super().insert(index, navpoint)
+        self._attach(navpoint)
+
+    def extend(self, navpoints):
+        for navpoint in navpoints:
+            self.append(navpoint)
+
+    def __iadd__(self, navpoints):
+        self.extend(navpoints)
+        return self
+
+    def remove(self, navpoint):
+        super().remove(navpoint)
+        self._detach([navpoint])
+
+    def pop(self, index=-1):
+        navpoint = super().pop(index)
+        self._detach([navpoint])
+        return navpoint
+
+    def clear(self):
+        removed = list(self)
+        super().clear()
+        self._detach(removed)
+
+    def __setitem__(self, index, value):
+        removed = self[index] if isinstance(index, slice) else [self[index]]
+        added = list(value) if isinstance(index, slice) else [value]
+        for navpoint in added:
+            self._check(navpoint)
+        super().__setitem__(index, added if isinstance(index, slice)
+                            else value)
+        self._detach(removed)
+        for navpoint in added:
+            self._attach(navpoint)
+
+    def __delitem__(self, index):
+        removed = self[index] if isinstance(index, slice) else [self[index]]
+        super().__delitem__(index)
+        self._detach(removed)
+
+    @staticmethod
+    def _check(navpoint):
+        if not isinstance(navpoint, NavPoint):
+            raise TypeError('\'navpoint\' object is not NavPoint')
+
+    def _attach(self, navpoint):
+        """navpoint已经加入到这一层之后调用:更新层数与索引"""
+        navpoint._parent = self
+        self._grow(navpoint._height + 1)
+        root = self.root
+        if isinstance(root, NavMap):
+            root.register(navpoint)
+
+    def _detach(self, navpoints):
+        """navpoints已经从这一层移除之后调用:更新层数与索引"""
+        root = self.root
+        for navpoint in navpoints:
+            navpoint._parent = None
+            if isinstance(root, NavMap):
+                root.unregister(navpoint)
+        self._shrink()
+
+    def _grow(self, height: int):
+        """子树层数增长为height,并向上传递"""
+        node = self
+        while node is not None and node._height < height:
+            node._height = height
+            node = node._parent
+            height += 1
+
+    def _shrink(self):
+        """下层节点被移除后,重新计算子树层数,并向上传递"""
+        node = self
+        while node is not None:
+            height = 1 + max([e._height for e in node] or [0])
+            if height == node._height:
+                break
+            node._height = height
+            node = node._parent
+
+    @property
+    def root(self):
+        """这个节点所在结构的顶层节点"""
+        node = self
+        while node._parent is not None:
+            node = node._parent
+        return node
+
+    @property
+    def parent(self):
+        """上层节点,顶层节点的上层节点为None"""
+        return self._parent
+
     def getnode(self, *path):
         """在多层中按指定路径找到特定的节点
         path: 一个列表,按顺序列出每一层的src
@@ -406,10 +888,9 @@ class NavPoint(_XML):
         nodes = [self]
         for src in path:
             for e in nodes[-1]:
-                if isinstance(e, NavPoint):
-                    if e.id == src:
-                        nodes.append(e)
-                        break
+                if e.id == src:
+                    nodes.append(e)
+                    break
         return nodes[-1]
 
     def getpath(self, lastid: str = '') -> list:
@@ -417,64 +898,155 @@ class NavPoint(_XML):
         if self.id == lastid:
             return [lastid]
         for item in self:
-            if isinstance(item, NavPoint):
-                path = item.getpath(lastid)
-                if path:
-                    return [self.id] + path
+            path = item.getpath(lastid)
+            if path:
+                return [self.id] + path
 
     @property
     def depth(self):
         """这个多层结构的最大深度"""
-        try:
-            element = filter(lambda x: isinstance(x, NavPoint), self)
-            depth = max(e.depth for e in element) + 1
-        except (ValueError,):
-            depth = 1
-        return depth
+        return self._height
+
+    def iterxml(self, level: int = 0, order=None):
+        """逐段生成xml,navLabel/content元素与playOrder在这里生成
+        order: 分配playOrder的计数器,不指定时从1开始
+        """
+        if order is None:
+            order = count(1)
+        prefix = '  ' * level
+        inner = prefix + '  '
+        yield _indentlines('<navPoint id="{}" playOrder="{}"{}>'.format(
+            self.id, next(order), self.propertyxml), prefix)
+        yield '\n{0}<navLabel>\n{1}\n{0}</navLabel>\n{2}'.format(
+            inner,
+            _indentlines('<text>{}</text>'.format(self.label), inner + '  '),
+            _indentlines('<content src="{}" />'.format(self.src), inner))
+        for e in self:
+            yield '\n'
+            yield from e.iterxml(level + 1, order)
+        yield '\n{}</navPoint>'.format(prefix)
 
     @classmethod
     def reorder(cls):
-        """使所有节点order从1开始自增(应当在调用顶层xml之前调用它)"""
-        cls.__order = 0
+        """playOrder在每次输出xml时都从1开始,不再需要调用它,保留它只为兼容
+        它只重置nextorder的计数器
+        """
+        NavPoint._order = 0
 
     @classmethod
     def nextorder(cls):
-        cls.__order += 1
-        return cls.__order
+        """输出xml时不再使用它(见iterxml的order),保留它只为兼容
+        返回一个进程中共用的,由reorder重置的自增序号
+        """
+        NavPoint._order += 1
+        return NavPoint._order
 
 
 class NavMap(NavPoint):
-    """NavMap是NcxItem的顶层封装,额外实现xml方法"""
+    """NavMap是NcxItem的顶层封装,额外实现xml方法
+    它以id为所有下层节点建立了索引,配合每个节点记录的上层节点,
+    查找节点与得到节点路径的代价只与节点所在的层数有关
+    当有多个节点的id相同时,索引指向其中最先加入的那一个,
+    它被移除后索引指向剩余的同id节点中的第一个(按结构中的顺序)
+    """
+    __slots__ = ('_nodes', '_shared')
 
     def __init__(self):
         super().__init__()
         self.name = 'navMap'
-        self.args = {}
-        self.clear()
+        self.id = None
+        self._nodes = {}
+        self._shared = set()  # 出现过重复的id
+
+    def register(self, navpoint: NavPoint):
+        """将navpoint及它的全部下层节点加入索引
+        向这个结构中的任意节点添加下层节点时会自动调用它
+        """
+        nodes = [navpoint]
+        while nodes:
+            node = nodes.pop()
+            if self._nodes.setdefault(node.id, node) is not node:
+                self._shared.add(node.id)
+            nodes.extend(node)
+
+    def unregister(self, navpoint: NavPoint):
+        """将navpoint及它的全部下层节点移出索引
+        从这个结构中的任意节点移除下层节点时会自动调用它
+        """
+        nodes = [navpoint]
+        while nodes:
+            node = nodes.pop()
+            nodes.extend(node)
+            if self._nodes.get(node.id) is not node:
+                continue
+            del self._nodes[node.id]
+            if node.id in self._shared:
+                other = self._find(node.id)
+                if other is None:
+                    self._shared.discard(node.id)
+                else:
+                    self._nodes[node.id] = other
+
+    def _find(self, nodeid: str):
+        """按结构中的顺序遍历,寻找id为nodeid的第一个节点"""
+        nodes = list(reversed(self))
+        while nodes:
+            node = nodes.pop()
+            if node.id == nodeid:
+                return node
+            nodes.extend(reversed(node))
+        return None
+
+    def lookup(self, src: str):
+        """寻找src对应的节点,没有时返回None"""
+        return self._nodes.get(hrefid(src))
+
+    def _pathof(self, node: NavPoint) -> list:
+        """得到node自这一层之下的路径"""
+        path = []
+        while node is not None and node is not self:
+            path.append(node.id)
+            node = node._parent
+        path.reverse()
+        return path
+
+    def getnode(self, *path):
+        """通过索引直接找到路径最后一项对应的节点
+        只有当该节点的实际路径与path不一致时,才按path逐层查找
+        """
+        if len(path) > 0:
+            node = self._nodes.get(path[-1])
+            if node is not None and self._pathof(node) == list(path):
+                return node
+        return super().getnode(*path)
 
     def getpath(self, src: str = '') -> list:
         """NavMap.getpath()不返回自己这一层"""
-        path = super().getpath(hrefid(src))
-        if path:
-            # path[0]指向了navmap自己
-            return path[1:]
-        else:
+        node = self.lookup(src)
+        if node is None:
             raise QuotedNothing(src)
+        return self._pathof(node)
 
     @property
     def depth(self):
         """NavMap.depth不包含自身这一层"""
         return super().depth - 1
 
-    @property
-    def xml(self):
-        """在取得xml前要调用reorder来使order重新初始始化
-        这是顶层对象才需要做的事
+    def iterxml(self, level: int = 0, order=None):
+        """NavMap本身没有navLabel/content与playOrder,
+        它的下层节点共用一个计数器来分配playOrder
         """
-        self.reorder()
-        xml = super().xml
-        self.reorder()
-        return xml
+        if order is None:
+            order = count(1)
+        prefix = '  ' * level
+        if len(self) == 0:
+            yield '{}<{}{} />'.format(prefix, self.name, self.propertyxml)
+            return
+        yield '{}<{}{}>'.format(prefix, self.name, self.propertyxml)
+        for e in self:
+            yield '\n'
+            yield from e.iterxml(level + 1, order)
+        yield '\n{}</{}>'.format(prefix, self.name)
 
 
 if __name__ == '__main__':
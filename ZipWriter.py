@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""zip条目的底层写入
+zipfile只能在写入时压缩,这里补充了写入预先压缩好的条目的功能,
+以便在多个线程中并行压缩,再按顺序追加到zip中
+预先压缩好的条目在写入文件头时就知道CRC与大小,因此也可以写入到不能seek的流中
+"""
+
+import sys
+import zipfile
+import zlib
+import time
+import struct
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+# writeraw/readraw依赖的zipfile内部实现(zipfile没有公开写入原始条目的接口)
+_WRITE_INTERNALS = ('fp', '_lock', '_writing', '_seekable', '_didModify',
+                    'start_dir', '_writecheck')
+_READ_INTERNALS = ('fp', '_lock')
+_HEADER_INTERNALS = ('_FH_FILENAME_LENGTH', '_FH_EXTRA_FIELD_LENGTH')
+
+# 已经是压缩格式的文件,再做deflate得不到什么好处,它们总是以存储方式写入
+STORED_EXTS = ('jpg', 'jpeg', 'png', 'gif', 'webp',
+               'mp3', 'mp4', 'm4a', 'ogg',
+               'zip', 'gz', 'epub', 'woff', 'woff2')
+
+
+def compresstype(name: str) -> int:
+    """根据条目名决定条目的压缩方式
+    mimetype必须以存储方式写入,已经压缩过的媒体文件也以存储方式写入
+    """
+    if name == 'mimetype' or name.rsplit('.', 1)[-1].lower() in STORED_EXTS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def _internals(obj, names: tuple):
+    """检查obj(ZipFile或zipfile模块)具备names列出的内部属性,返回obj
+    只有这里知道依赖了哪些内部实现,zipfile改变了它们时明确地报错,
+    而不是在写入到一半时出现难以理解的错误
+    """
+    missing = [name for name in names if not hasattr(obj, name)]
+    if missing:
+        raise RuntimeError('zipfile of this Python ({}) lacks internals '
+                           'needed by ZipWriter: {}'.format(
+                               sys.version.split()[0], ', '.join(missing)))
+    return obj
+
+
+def setlevel(zinfo: zipfile.ZipInfo, level: int):
+    """设置以ZipFile.open(zinfo, 'w')写入时使用的deflate压缩级别
+    level: deflate压缩级别(0-9),-1为zlib的默认级别
+    """
+    if hasattr(zinfo, 'compress_level'):
+        zinfo.compress_level = level  # Python 3.13+
+    else:
+        zinfo._compresslevel = level  # Python 3.7+,更早的版本忽略它
+
+
+def compressentry(name: str, data, level: int = -1, date_time=None):
+    """按compresstype(name)压缩一个条目
+    返回(zinfo, 压缩后的数据),它们可以直接交给writeraw
+    data: str(以utf-8编码)或bytes
+    level: deflate压缩级别(0-9),-1为zlib的默认级别
+    date_time: 条目的时间,默认为当前时间
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if date_time is None:
+        date_time = time.localtime(time.time())[:6]
+    zinfo = zipfile.ZipInfo(name, date_time)
+    zinfo.compress_type = compresstype(name)
+    zinfo.external_attr = 0o600 << 16
+    zinfo.file_size = len(data)
+    zinfo.CRC = zlib.crc32(data)
+    if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        data = compressor.compress(data) + compressor.flush()
+    return zinfo, data
+
+
+def writeraw(z: zipfile.ZipFile, zinfo: zipfile.ZipInfo, data: bytes):
+    """将已经压缩好的数据data作为一个条目写入z
+    zinfo: 条目信息,它的compress_type/CRC/file_size需要与data一致
+    data: 已经按zinfo.compress_type压缩好的数据(deflate为不带头的原始流)
+    CRC与大小在写入前就已知,因此不需要回写文件头,也不需要数据描述符
+    """
+    _internals(z, _WRITE_INTERNALS)
+    zinfo.compress_size = len(data)
+    zinfo.flag_bits = 0
+    zip64 = max(zinfo.file_size, zinfo.compress_size) > zipfile.ZIP64_LIMIT
+    with z._lock:
+        if z._writing:
+            raise ValueError("Can't write to the ZIP file while there is "
+                             "another write handle open on it.")
+        if z._seekable:
+            z.fp.seek(z.start_dir)
+        zinfo.header_offset = z.fp.tell()
+        z._writecheck(zinfo)
+        z._didModify = True
+        z.fp.write(zinfo.FileHeader(zip64))
+        z.fp.write(data)
+        z.start_dir = z.fp.tell()
+        z.filelist.append(zinfo)
+        z.NameToInfo[zinfo.filename] = zinfo
+
+
+def readraw(src: zipfile.ZipFile, zinfo: zipfile.ZipInfo) -> bytes:
+    """读出src中条目zinfo压缩后的原始数据(不解压)"""
+    _internals(src, _READ_INTERNALS)
+    fields = _internals(zipfile, _HEADER_INTERNALS)
+    with src._lock:
+        src.fp.seek(zinfo.header_offset)
+        header = struct.unpack(zipfile.structFileHeader,
+                               src.fp.read(zipfile.sizeFileHeader))
+        src.fp.seek(header[fields._FH_FILENAME_LENGTH] +
+                    header[fields._FH_EXTRA_FIELD_LENGTH], 1)
+        return src.fp.read(zinfo.compress_size)
+
+
+def copyraw(src: zipfile.ZipFile, zinfo: zipfile.ZipInfo,
+            z: zipfile.ZipFile):
+    """将src中的条目zinfo原样复制到z中,不解压也不重新压缩"""
+    new = zipfile.ZipInfo(zinfo.filename, zinfo.date_time)
+    new.compress_type = zinfo.compress_type
+    new.external_attr = zinfo.external_attr
+    new.CRC = zinfo.CRC
+    new.file_size = zinfo.file_size
+    writeraw(z, new, readraw(src, zinfo))
+
+
+class DeflateWriter(object):
+    """压缩条目并按提交的顺序追加到zip中
+    workers大于1时,压缩在一组工作线程中进行(zlib在压缩时会释放GIL),
+    写入仍在调用者的线程中按提交顺序进行.
+    为了限制内存占用,最多只有window个条目处于压缩或等待写入的状态.
+    z: 以'w'模式打开的ZipFile
+    workers: 工作线程数,小于等于1时在调用者的线程中压缩
+    level: deflate压缩级别(0-9),-1为zlib的默认级别
+    window: 同时处于压缩中的条目数上限,默认为workers的2倍
+    date_time: 条目的时间,默认为写入时的时间
+    autoflush: 每写入一个条目就刷新z的文件对象,用于向管道/socket等流式输出时,
+        使已经写入的条目尽快到达对方
+    """
+
+    def __init__(self, z: zipfile.ZipFile, workers: int = 1,
+                 level: int = -1, window: int = None, date_time=None,
+                 autoflush: bool = False):
+        self.z = z
+        self.level = level
+        self.date_time = date_time
+        self.autoflush = autoflush
+        self._pool = None
+        self._pending = deque()
+        if workers > 1:
+            self._pool = ThreadPoolExecutor(workers)
+        self.window = window or max(workers, 1) * 2
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def _writeraw(self, zinfo, data):
+        writeraw(self.z, zinfo, data)
+        if self.autoflush:
+            self.z.fp.flush()
+
+    def write(self, name: str, data):
+        """压缩一个条目,它会在之前提交的条目都写入后写入"""
+        if self._pool is None:
+            self._writeraw(*compressentry(name, data, self.level,
+                                          self.date_time))
+            return
+        self._pending.append(self._pool.submit(compressentry, name, data,
+                                               self.level, self.date_time))
+        while self._pending and (self._pending[0].done() or
+                                 len(self._pending) > self.window):
+            self._writeraw(*self._pending.popleft().result())
+
+    def flush(self):
+        """等待所有已提交的条目压缩完毕并写入"""
+        while self._pending:
+            self._writeraw(*self._pending.popleft().result())
+
+    def open(self, name: str):
+        """在之前提交的条目都写入后,打开一个逐段写入的条目,返回可写的文件对象
+        用于事先不知道完整内容的条目,它与write()使用相同的压缩方式,级别与时间
+        """
+        self.flush()
+        zinfo = zipfile.ZipInfo(
+            name, self.date_time or time.localtime(time.time())[:6])
+        zinfo.compress_type = compresstype(name)
+        zinfo.external_attr = 0o600 << 16
+        setlevel(zinfo, self.level)
+        return self.z.open(zinfo, 'w')
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+class CRCWriter(object):
+    """只计算写入内容的CRC与大小的二进制文件对象"""
+
+    def __init__(self):
+        self.CRC = 0
+        self.size = 0
+
+    def write(self, b: bytes):
+        self.CRC = zlib.crc32(b, self.CRC)
+        self.size += len(b)
+        return len(b)
+
+
+def fingerprint(z: zipfile.ZipFile) -> str:
+    """zip内容的指纹,它由各条目按顺序的名字,大小与CRC计算得到
+    它与条目的时间及压缩方式无关,只要条目的内容与顺序相同,指纹就相同
+    """
+    digest = hashlib.sha256()
+    for zinfo in z.infolist():
+        digest.update('{}\0{}\0{}\n'.format(
+            zinfo.filename, zinfo.file_size, zinfo.CRC).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ReuseWriter(DeflateWriter):
+    """以一个已有的zip为参照写入条目,在内容没有变化时不写入任何东西
+    只要写入的条目与参照中相同位置的条目一致(名字,大小与CRC都相同),
+    它就只被记下而不压缩也不写入.
+    出现第一个不一致的条目时才打开要写入的zip,把记下的条目从参照中原样复制过去,
+    此后的条目正常写入.
+    如果全部条目都与参照一致,changed为False,要写入的zip不会被建立.
+    open: 返回一个以'w'模式打开的ZipFile的函数,它在需要写入时才被调用,
+        得到的ZipFile在close()时关闭
+    ref: 作为参照的ZipFile,为None时与DeflateWriter相同
+    其它参数与DeflateWriter相同
+    """
+
+    def __init__(self, open, ref: zipfile.ZipFile = None, workers: int = 1,
+                 level: int = -1, window: int = None, date_time=None,
+                 autoflush: bool = False):
+        super().__init__(None, workers, level, window, date_time, autoflush)
+        self._open = open
+        self._ref = ref
+        self._refinfo = ref.infolist() if ref is not None else []
+        self._reused = 0
+        self.matching = ref is not None
+        if not self.matching:
+            self.z = open()
+
+    @property
+    def changed(self) -> bool:
+        return not self.matching
+
+    def reuse(self, name: str, size: int, crc: int) -> bool:
+        """检查下一个条目是否与参照中的一致
+        一致时记下它并返回True,否则开始写入并返回False,调用者需要自己写入这个条目
+        """
+        if self.matching:
+            if self._reused < len(self._refinfo):
+                ref = self._refinfo[self._reused]
+                if (ref.filename, ref.file_size, ref.CRC) == (name, size, crc):
+                    self._reused += 1
+                    return True
+            self._diverge()
+        return False
+
+    def _diverge(self):
+        """开始写入,将已经记下的条目从参照中原样复制到zip中"""
+        self.matching = False
+        self.z = self._open()
+        for zinfo in self._refinfo[:self._reused]:
+            copyraw(self._ref, zinfo, self.z)
+
+    def write(self, name: str, data):
+        if self.matching:
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            if self.reuse(name, len(data), zlib.crc32(data)):
+                return
+        super().write(name, data)
+
+    def copy(self, src: zipfile.ZipFile, zinfo: zipfile.ZipInfo):
+        """将src中的条目zinfo原样复制到zip中"""
+        if self.reuse(zinfo.filename, zinfo.file_size, zinfo.CRC):
+            return
+        self.flush()
+        copyraw(src, zinfo, self.z)
+
+    def close(self):
+        try:
+            if self.matching and self._reused < len(self._refinfo):
+                self._diverge()  # 参照中还有多余的条目
+            super().close()
+        finally:
+            if self.z is not None:
+                self.z.close()
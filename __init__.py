@@ -3,8 +3,9 @@
 from OPF import XhtmlDoc
 from EpubCreater import createepub, getgenerator, recreate
 from Iterators import default_textengine, autoname, \
-    htmltodoc, filetodoc, dirtodoc, getfileencode,\
-    iter_page, iter_url, iter_txt, iter_dir, iter_files
+    htmltodoc, faileddoc, filetodoc, dirtodoc, getfileencode, detectencode, \
+    EncodeCache, iter_page, aiter_page, iter_url, iter_txt, iter_bigtxt, iter_dir, \
+    iter_files
 
 
 __all__ = ['XhtmlDoc',
@@ -14,12 +15,17 @@ __all__ = ['XhtmlDoc',
            'default_textengine',
            'autoname',
            'htmltodoc',
+           'faileddoc',
            'filetodoc',
            'dirtodoc',
            'getfileencode',
+           'detectencode',
+           'EncodeCache',
            'iter_page',
+           'aiter_page',
            'iter_url',
            'iter_txt',
+           'iter_bigtxt',
            'iter_dir',
            'iter_files',
            ]
@@ -0,0 +1,645 @@
+# -*- coding: utf-8 -*-
+"""性能测试
+每个测试以bench_开头,接受一个规模参数,返回一个结果描述串
+可以在命令行中指定要进行的测试(不含前缀bench_),不指定则进行全部测试:
+    python benchmark.py opf
+"""
+
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import tracemalloc
+from urllib.request import urlopen
+from OPF import Mainfest, Spine, ManifestItem, CoreMediaType
+from OPF import NavMap, NavPoint, SpineItem, MetaItem, XhtmlDoc
+from EpubCreater import createepub, recreate, getgenerator, EpubCreater
+from Iterators import iter_txt, iter_bigtxt, iter_dir, iter_page, \
+    iter_url, getfileencode, EncodeCache
+from bookserver import BookServer
+from Fetcher import Fetcher, HttpCache, HostScheduler
+
+
+def timeit(func, *args):
+    """执行func(*args)并返回所用的时间(秒)"""
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def scaling(func, sizes):
+    """以不同规模执行func,列出每个规模的总用时与单项平均用时
+    如果func是线性的,单项平均用时应当大致保持不变
+    """
+    lines = []
+    for n in sizes:
+        t = timeit(func, n)
+        lines.append('  n={:>7}: {:8.3f}s {:8.2f}us/item'.format(
+            n, t, t / n * 1000000))
+    return '\n'.join(lines)
+
+
+def build_opf(n):
+    """建立一个有n个文档的Mainfest与Spine"""
+    mainfest = Mainfest()
+    spine = Spine(mainfest)
+    mainfest.append(ManifestItem('toc.ncx', CoreMediaType.dtbncx, id='ncx'))
+    for i in range(n):
+        name = 'Text/{}.xhtml'.format(i)
+        mainfest.append(ManifestItem(name, CoreMediaType.xhtml))
+        spine.append(name)
+    return mainfest, spine
+
+
+def bench_opf(sizes=(10000, 20000, 40000)):
+    """Mainfest/Spine的建立时间应当与文档数量成线性关系"""
+    return 'Mainfest+Spine:\n' + scaling(build_opf, sizes)
+
+
+def build_nav(n):
+    """建立一个有n个文档的多层NavMap,第i个文档按src加在第i//10个文档之下"""
+    nav = NavMap()
+    parents = ['']
+    for i in range(n):
+        name = 'Text/{}.xhtml'.format(i)
+        parent = nav.lookup(parents[i // 10])
+        if parent is None:
+            parent = nav
+        parent.append(NavPoint(name, name))
+        parents.append(name)
+    return nav.depth
+
+
+def bench_nav(sizes=(10000, 20000, 40000)):
+    """按上层文档添加节点的时间应当与文档数量成线性关系"""
+    return 'NavMap:\n' + scaling(build_nav, sizes)
+
+
+class NullWriter(object):
+    """丢弃写入内容的二进制文件对象,只记录写入的字节数"""
+    size = 0
+
+    def write(self, b):
+        self.size += len(b)
+
+
+def peakmemory(func, *args):
+    """执行func(*args)期间新分配内存的峰值(字节)"""
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak - base
+
+
+def bench_serialize(sizes=(5000, 10000, 20000)):
+    """输出NavMap时的内存峰值:xml串(增长) vs writexml(保持不变)"""
+    lines = ['NavMap serialize peak memory:']
+    for n in sizes:
+        nav = NavMap()
+        for i in range(n):
+            name = 'Text/{}.xhtml'.format(i)
+            parent = nav.lookup('Text/{}.xhtml'.format(i // 10 - 1))
+            (parent or nav).append(NavPoint(name, name))
+        text = peakmemory(lambda: nav.xml.encode('utf-8'))
+        stream = peakmemory(nav.writexml, NullWriter())
+        lines.append('  n={:>7}: xml {:8.1f}KB  writexml {:8.1f}KB'.format(
+            n, text / 1024, stream / 1024))
+    return '\n'.join(lines)
+
+
+def bench_nodes(n=20000):
+    """每个节点占用的内存(字节)"""
+    names = ['Text/{}.xhtml'.format(i) for i in range(n)]
+    nodes = [('ManifestItem',
+              lambda i: ManifestItem(names[i], CoreMediaType.xhtml)),
+             ('SpineItem', lambda i: SpineItem(names[i])),
+             ('NavPoint', lambda i: NavPoint(names[i], names[i])),
+             ('MetaItem', lambda i: MetaItem('source:' + names[i], 'v')),
+             ('XhtmlDoc', lambda i: XhtmlDoc(names[i], names[i]))]
+    lines = ['memory per node:']
+    for name, func in nodes:
+        size = peakmemory(lambda: [func(i) for i in range(n)])
+        lines.append('  {:<12}: {:8.1f}B'.format(name, size / n))
+    return '\n'.join(lines)
+
+
+def chapters(n, size, seed=0):
+    """生成n个内容随机的章节,每章约size个字符"""
+    rnd = random.Random(seed)
+    words = [chr(c) for c in range(0x4e00, 0x4e00 + 2000)]
+    for i in range(n):
+        lines = []
+        for _ in range(size // 50):
+            lines.append('  <p>{}</p>'.format(
+                ''.join(rnd.choice(words) for _ in range(50))))
+        yield XhtmlDoc('Text/{}.xhtml'.format(i),
+                       '第{}章'.format(i + 1),
+                       '\n'.join(lines))
+
+
+def paragraphs(s):
+    """简单的文本翻译器,每行一个段落"""
+    return '\n'.join('  <p>{}</p>'.format(line) for line in s.split('\n'))
+
+
+def bench_render(n=200, size=200000):
+    """使用翻译器的文档,读取两次html再取得编码后的内容:
+    每次重新生成 vs 保存生成的结果
+    """
+    sources = [(doc.name, doc.title, doc.data, '', True, paragraphs)
+               for doc in chapters(n, size)]
+
+    def uncached():
+        for source in sources:
+            doc = XhtmlDoc(*source)
+            len(doc._render())
+            len(doc._render())
+            len(doc._render().encode('utf-8'))
+
+    def cached():
+        for source in sources:
+            doc = XhtmlDoc(*source)
+            len(doc.html)
+            len(doc.html)
+            len(doc.encoded)
+    return 'render {} chapters x {} chars:\n' \
+           '  uncached {:8.3f}s  cached {:8.3f}s'.format(
+               n, size, timeit(uncached), timeit(cached))
+
+
+class PlainDoc(object):
+    """以普通属性保存内容的文档,用于对比 data += s 的方式"""
+    data = ''
+
+
+def bench_builder(sizes=(1000, 2000, 4000, 8000)):
+    """逐行构建一个章节:doc.data += line vs doc.append(line)
+    前者的单行平均用时随行数增长,后者保持不变
+    """
+    line = '  <p>{}</p>\n'.format('字' * 100)
+
+    def concat(n):
+        doc = PlainDoc()
+        for _ in range(n):
+            doc.data += line
+        return len(doc.data)
+
+    def append(n):
+        doc = XhtmlDoc()
+        for _ in range(n):
+            doc.append(line)
+        return len(doc.data)
+    return 'data +=:\n' + scaling(concat, sizes) + \
+           '\nappend():\n' + scaling(append, sizes)
+
+
+def novel(filename, mb):
+    """生成一个约mb兆字节的单文件小说,每章约200KB"""
+    para = '　　' + '这是一段小说的正文内容。' * 20 + '\n'
+    with open(filename, 'w', encoding='utf-8') as fp:
+        size, chapter = 0, 0
+        while size < mb * 1048576:
+            chapter += 1
+            text = '第{}章 标题\n'.format(chapter) + para * 300
+            fp.write(text)
+            size += len(text.encode('utf-8'))
+
+
+def bench_novel(mb=200):
+    """用iter_txt分析一个mb兆字节的单文件小说并生成全部章节的html"""
+    home = tempfile.mkdtemp()
+    filename = os.path.join(home, 'novel.txt')
+    novel(filename, mb)
+    docs = [0, 0]
+
+    def run():
+        for doc in iter_txt(filename, titlere='^第.*'):
+            docs[0] += 1
+            docs[1] += len(doc.encoded)
+    t = timeit(run)
+    os.remove(filename)
+    os.rmdir(home)
+    return 'iter_txt {}MB novel: {} chapters, {:.1f}MB html\n' \
+           '  {:8.3f}s {:8.1f}MB/s'.format(mb, docs[0], docs[1] / 1048576,
+                                           t, mb / t)
+
+
+def bench_bigtxt(mb=200):
+    """分析一个mb兆字节的单文件小说得到全部章节(不生成html):
+    iter_txt vs iter_bigtxt(首次扫描/使用索引),以及它们的内存峰值
+    """
+    home = tempfile.mkdtemp()
+    filename = os.path.join(home, 'novel.txt')
+    novel(filename, mb)
+    lines = ['ingest {}MB novel:'.format(mb)]
+
+    def ingest(it, **kwargs):
+        return lambda: len(list(it(filename, titlere='^第.*', **kwargs)))
+    ingest(iter_bigtxt)()  # 建立索引文件
+    for name, func in (('iter_txt', ingest(iter_txt)),
+                       ('iter_bigtxt', ingest(iter_bigtxt, index=False)),
+                       ('indexed', ingest(iter_bigtxt))):
+        t = timeit(func)
+        peak = peakmemory(func)
+        lines.append('  {:<12}: {:8.3f}s  peak {:8.1f}MB'.format(
+            name, t, peak / 1048576))
+    for name in os.listdir(home):
+        os.remove(os.path.join(home, name))
+    os.rmdir(home)
+    return '\n'.join(lines)
+
+
+def bench_resume(mb=50):
+    """向mb兆字节的单文件小说追加一章后重新生成:
+    完全重新生成 vs 以续读标记只分析追加的内容
+    """
+    home = tempfile.mkdtemp()
+    filename = os.path.join(home, 'novel.txt')
+    novel(filename, mb)
+    kwgs = {'_generator': 'Iterators.iter_txt', 'file': filename,
+            'titlere': '^第.*', 'mark': ''}
+    full = os.path.join(home, 'full.epub')
+    marked = os.path.join(home, 'marked.epub')
+    createepub(marked, getgenerator(state=kwgs, **kwgs), meta=kwgs,
+               showlog=False)
+    with open(filename, 'a', encoding='utf-8') as fp:
+        fp.write('第99999章 新的一章\n' + '　　新的内容。\n' * 300)
+    rebuild = timeit(lambda: createepub(
+        full, iter_txt(filename, titlere='^第.*'), showlog=False))
+    resume = timeit(recreate, marked, False)
+    for name in os.listdir(home):
+        os.remove(os.path.join(home, name))
+    os.rmdir(home)
+    return 'append a chapter to {}MB novel:\n' \
+           '  rebuild {:8.3f}s  resume {:8.3f}s'.format(mb, rebuild, resume)
+
+
+def bench_encode(n=400, size=256 * 1024):
+    """识别n个约size字节的gbk文件的编码:
+    getfileencode(读出整个文件) vs EncodeCache(抽样,第二次使用缓存)
+    """
+    home = tempfile.mkdtemp()
+    text = ('　　' + '这是一段小说的正文内容。' * 20 + '\n') * (size // 250)
+    files = []
+    for i in range(n):
+        files.append(os.path.join(home, '{}.txt'.format(i)))
+        with open(files[-1], 'w', encoding='gbk') as fp:
+            fp.write(text + '.')  # 奇数长度,不会被识别为utf_16
+
+    def cached():
+        with EncodeCache() as encodes:
+            return [encodes.getencode(file) for file in files]
+    full = timeit(lambda: [getfileencode(file) for file in files])
+    first = timeit(cached)
+    second = timeit(cached)
+    for name in os.listdir(home):
+        os.remove(os.path.join(home, name))
+    os.rmdir(home)
+    return 'detect encoding of {} files x {}KB:\n' \
+           '  getfileencode {:8.3f}s  sampled {:8.3f}s  cached {:8.3f}s'.format(
+               n, size // 1024, full, first, second)
+
+
+def bench_ingest(n=200, size=256 * 1024, workers=(1, 4)):
+    """用iter_dir处理一个有n个约size字节的txt文件的目录:
+    逐个处理 vs 在一组线程/进程中并行处理(使用的cpu数见os.cpu_count())
+    """
+    home = tempfile.mkdtemp()
+    text = ''.join('第{}章 标题\n'.format(c) +
+                   ('　　' + '这是一段小说的正文内容。' * 20 + '\n') * 10
+                   for c in range(size // 7500))
+    for i in range(n):
+        with open(os.path.join(home, '{}.txt'.format(i)), 'w',
+                  encoding='utf-8') as fp:
+            fp.write(text)
+
+    def ingest(**kwargs):
+        return lambda: sum(len(doc.data) for doc in iter_dir(
+            home, exts='txt', titlere='第.*', **kwargs))
+    lines = ['iter_dir {} files x {}KB ({} cpus):'.format(
+        n, size // 1024, os.cpu_count())]
+    ingest()()  # 建立编码缓存
+    for worker in workers:
+        lines.append('  workers={}: threads {:8.3f}s  processes {:8.3f}s'
+                     .format(worker, timeit(ingest(workers=worker)),
+                             timeit(ingest(workers=worker, processes=True))))
+    for name in os.listdir(home):
+        os.remove(os.path.join(home, name))
+    os.rmdir(home)
+    return '\n'.join(lines)
+
+
+def bench_manifest(n=1000, size=128 * 1024):
+    """n个文件的目录中改变了一个文件后recreate:完全重建 vs 使用清单"""
+    home = tempfile.mkdtemp()
+    text = ''.join('第{}章 标题\n'.format(c) +
+                   ('　　' + '这是一段小说的正文内容。' * 20 + '\n') * 10
+                   for c in range(size // 7500))
+    for i in range(n):
+        sub = os.path.join(home, str(i % 10))
+        os.makedirs(sub, exist_ok=True)
+        with open(os.path.join(sub, '{}.txt'.format(i)), 'w',
+                  encoding='utf-8') as fp:
+            fp.write(text)
+    out = tempfile.mkdtemp()
+    lines = ['recreate {} files x {}KB, 1 changed:'.format(n, size // 1024)]
+    for manifest in ('', os.path.join(out, 'book.json')):
+        filename = os.path.join(out, 'book.epub')
+        meta = {'_generator': 'Iterators.iter_dir', 'homedir': home,
+                'exts': 'txt', 'includesubdir': True, 'titlere': '第.*',
+                'encode': 'utf-8', 'manifest': manifest}
+        createepub(filename, getgenerator(**meta), showlog=False, meta=meta)
+        with open(os.path.join(home, '0', '0.txt'), 'a',
+                  encoding='utf-8') as fp:
+            fp.write('第末章 续\n　　又一段。\n')
+        t = timeit(lambda: recreate(filename, showlog=False))
+        lines.append('  {}: {:8.3f}s'.format(
+            'manifest' if manifest else 'rebuild ', t))
+    shutil.rmtree(home)
+    shutil.rmtree(out)
+    return '\n'.join(lines)
+
+
+def bench_crawl(n=200, latency=0.02, concurrency=(1, 8)):
+    """从本地网站(每个请求延迟latency秒)抓取n章:逐个下载 vs 并发下载"""
+    lines = ['iter_page {} chapters, {}ms per request:'.format(
+        n, int(latency * 1000))]
+    with BookServer(n, latency=latency) as server:
+        for c in concurrency:
+            t = timeit(lambda: sum(len(doc.html) for doc in iter_page(
+                server.url, BookServer.hrefre, titlere=BookServer.titlere,
+                concurrency=c)))
+            lines.append('  concurrency={:>2}: {:8.3f}s'.format(c, t))
+    return '\n'.join(lines)
+
+
+def bench_fetch(n=200, lines=50):
+    """从本地网站下载n个页面:每次新建连接且不压缩(urlopen) vs Fetcher"""
+    out = ['fetch {} pages:'.format(n)]
+
+    def fetch(get):
+        with BookServer(n, lines) as server:
+            t = timeit(lambda: [get('{}{}.html'.format(server.url, i))
+                                for i in range(1, n + 1)])
+            return '{:8.3f}s  {:>4} connections  {:>8} bytes'.format(
+                t, server.connections, server.sent)
+
+    def urlget(url):
+        with urlopen(url) as response:
+            return response.read().decode('utf-8')
+    out.append('  urlopen: ' + fetch(urlget))
+    with Fetcher() as fetcher:
+        out.append('  Fetcher: ' + fetch(fetcher.get))
+    return '\n'.join(out)
+
+
+def bench_recrawl(n=1000, new=5, lines=50):
+    """n章的书更新了new章之后重新抓取:不使用缓存 vs 缓存+重新验证
+    vs 缓存+章节页不再验证 vs 只使用缓存(离线)
+    """
+    path = tempfile.mkdtemp()
+    out = ['recrawl {} chapters, {} new:'.format(n + new, new)]
+    with BookServer(n, lines) as server:
+        def crawl(name, cache=None):
+            server.sent = 0
+            with Fetcher(cache=cache) as fetcher:
+                t = timeit(lambda: sum(len(doc.html) for doc in iter_page(
+                    server.url, BookServer.hrefre, titlere=BookServer.titlere,
+                    fetcher=fetcher)))
+            out.append('  {:<12}{:8.3f}s  {:>5} requests  {:>9} bytes'.format(
+                name, t, fetcher.requests, server.sent))
+        with HttpCache(path) as cache:
+            crawl('first', cache)
+        server.chapters += new
+        crawl('no cache')
+        with HttpCache(path) as cache:
+            crawl('revalidate', cache)
+        with HttpCache(path, immutable=[(r'/\d+\.html$', 0)]) as cache:
+            crawl('immutable', cache)
+        with HttpCache(path, offline=True) as cache:
+            crawl('offline', cache)
+    shutil.rmtree(path)
+    return '\n'.join(out)
+
+
+def bench_throttle(n=300, latency=0.02, maxactive=4, concurrency=16):
+    """从最多同时处理maxactive个请求(超出的回答429)的网站抓取n章:
+    不调度(只靠失败重试) vs HostScheduler
+    """
+    out = ['crawl {} chapters, server allows {} concurrent requests:'.format(
+        n, maxactive)]
+    with BookServer(n, latency=latency, maxactive=maxactive) as server:
+        for name, scheduler in (('no scheduler', None),
+                                ('HostScheduler', HostScheduler())):
+            server.throttled = 0
+            fetcher = Fetcher(scheduler=scheduler)
+            docs = []
+            t = timeit(lambda: docs.extend(iter_page(
+                server.url, BookServer.hrefre, concurrency=concurrency,
+                fetcher=fetcher)))
+            out.append('  {}: {:8.3f}s  {:>4} throttled  {:>4} retried  '
+                       '{} incomplete'.format(
+                           name, t, server.throttled, fetcher.retried,
+                           sum(not doc.complete for doc in docs)))
+    return '\n'.join(out)
+
+
+def bench_flaky(n=200, latency=0.01, rate=0.05, times=2, concurrency=8):
+    """从有rate比例的章节暂时不可用(前times次请求回答500)的网站抓取n章:
+    不重试(失败的章节只在最后再下载一次) vs 指数退避重试,后者得到完整的书
+    """
+    out = ['crawl {} chapters, {:.0%} fail {} times:'.format(n, rate, times)]
+    rnd = random.Random(1)
+    failures = {'/book/{}.html'.format(i): times
+                for i in range(1, n + 1) if rnd.random() < rate}
+    for retries in (0, 3):
+        with BookServer(n, latency=latency, failures=failures) as server:
+            fetcher = Fetcher(retries=retries, backoff=0.05)
+            docs = []
+            t = timeit(lambda: docs.extend(iter_page(
+                server.url, BookServer.hrefre, concurrency=concurrency,
+                fetcher=fetcher)))
+            out.append('  retries={}: {:8.3f}s  {:>3} docs  {:>3} failed '
+                       'requests  {} incomplete'.format(
+                           retries, t, len(docs), server.failed,
+                           sum(not doc.complete for doc in docs)))
+    return '\n'.join(out)
+
+
+def bench_journal(n=1000, killed=800, latency=0.005):
+    """iter_url抓取n章在第killed章中断后重新生成:从头抓取 vs 由日志继续"""
+    path = tempfile.mkdtemp()
+    journal = os.path.join(path, 'book.journal')
+    out = ['iter_url {} chapters, interrupted after {}:'.format(n, killed)]
+    with BookServer(n, latency=latency) as server:
+        def crawl(**kwargs):
+            return iter_url(server.root + '/{}/{}.html', 'book', 1,
+                            titlere=BookServer.titlere, **kwargs)
+        for name, kwargs in (('restart', {}),
+                             ('journal', {'journal': journal})):
+            it = crawl(**kwargs)
+            for _ in zip(range(killed), it):
+                pass
+            it.close()
+            requests = server.requests
+            filename = os.path.join(path, name + '.epub')
+            t = timeit(lambda: createepub(filename, crawl(**kwargs),
+                                          showlog=False))
+            out.append('  {:>7}: {:8.3f}s  {:>4} requests'.format(
+                name, t, server.requests - requests))
+    shutil.rmtree(path)
+    return '\n'.join(out)
+
+
+def bench_speculate(n=200, latency=0.02, ahead=(0, 4, 16)):
+    """iter_url抓取n章(每个请求延迟latency秒):不推测 vs 推测下载ahead页,
+    章节地址递增(可以推测)与无规律(不能推测)两种网站
+    """
+    out = ['iter_url {} chapters, {}ms per request:'.format(
+        n, int(latency * 1000))]
+    for unpredictable in (False, True):
+        with BookServer(n, latency=latency,
+                        unpredictable=unpredictable) as server:
+            for speculate in ahead:
+                stats = {}
+                requests = server.requests
+                t = timeit(lambda: list(iter_url(
+                    server.root + '/{}/{}.html', 'book', server.chapterid(1),
+                    titlere=BookServer.titlere, speculate=speculate,
+                    stats=stats)))
+                out.append('  {:>13} speculate={:>2}: {:8.3f}s  {:>4} requests'
+                           '  hit rate {}'.format(
+                               'unpredictable' if unpredictable else
+                               'predictable', speculate, t,
+                               server.requests - requests,
+                               '{:.0%}'.format(stats['hits'] /
+                                               stats['predicted'])
+                               if stats.get('predicted') else '-'))
+    return '\n'.join(out)
+
+
+def bench_refresh(n=2000, new=10, latency=0.005):
+    """连载中有n章的书增加了new章之后recreate:完全重新抓取 vs 续读标记"""
+    path = tempfile.mkdtemp()
+    out = ['recreate {} chapters, {} new:'.format(n + new, new)]
+    with BookServer(n, latency=latency) as server:
+        for name, mark in (('full', False), ('mark', True)):
+            server.chapters = n
+            filename = os.path.join(path, name + '.epub')
+            kwgs = {'_generator': 'Iterators.iter_page', 'url': server.url,
+                    'hrefre': BookServer.hrefre,
+                    'titlere': BookServer.titlere, 'concurrency': 8}
+            if mark:
+                kwgs['mark'] = ''
+            createepub(filename, getgenerator(state=kwgs, **kwgs)
+                       if mark else getgenerator(**kwgs),
+                       showlog=False, meta=kwgs)
+            server.chapters = n + new
+            requests = server.requests
+            t = timeit(lambda: recreate(filename, showlog=False))
+            out.append('  {:>4}: {:8.3f}s  {:>4} requests'.format(
+                name, t, server.requests - requests))
+    shutil.rmtree(path)
+    return '\n'.join(out)
+
+
+def bench_deflate(n=200, size=50000, workers=(1, 2, 4)):
+    """以不同的压缩线程数生成同一本书"""
+    docs = list(chapters(n, size))
+    home = tempfile.mkdtemp()
+    lines = ['deflate {} chapters x {} chars:'.format(n, size)]
+    for worker in workers:
+        filename = os.path.join(home, 'w{}.epub'.format(worker))
+        t = timeit(lambda: createepub(filename, iter(docs), showlog=False,
+                                      workers=worker))
+        lines.append('  workers={}: {:8.3f}s'.format(worker, t))
+        os.remove(filename)
+    os.rmdir(home)
+    return '\n'.join(lines)
+
+
+def bench_update(sizes=(200, 400, 800), new=10, size=20000):
+    """向已有n章的书追加new章:完全重建 vs update,后者应当几乎不随n增长"""
+    home = tempfile.mkdtemp()
+    lines = ['append {} chapters:'.format(new)]
+    for n in sizes:
+        docs = list(chapters(n + new, size))
+        filename = os.path.join(home, 'u{}.epub'.format(n))
+        full = timeit(lambda: createepub(filename, iter(docs), showlog=False))
+        createepub(filename, iter(docs[:n]), showlog=False)
+        update = timeit(lambda: createepub(filename, iter(docs[n:]),
+                                           showlog=False, update=True))
+        lines.append('  n={:>5}: rebuild {:8.3f}s  update {:8.3f}s'.format(
+            n, full, update))
+        os.remove(filename)
+    os.rmdir(home)
+    return '\n'.join(lines)
+
+
+def bench_ttfb(n=200, size=20000):
+    """通过socket输出epub:收到第一个字节的时间 vs 收到全部内容的时间"""
+    server, client = socket.socketpair()
+
+    def produce():
+        with server.makefile('wb') as fp:
+            createepub(fp, chapters(n, size), showlog=False, title='ttfb')
+        server.close()
+    producer = threading.Thread(target=produce)
+    start = time.perf_counter()
+    producer.start()
+    received = len(client.recv(65536))
+    ttfb = time.perf_counter() - start
+    while True:
+        data = client.recv(65536)
+        if not data:
+            break
+        received += len(data)
+    total = time.perf_counter() - start
+    producer.join()
+    client.close()
+    return 'stream {} chapters ({:.1f}MB) to socket:\n' \
+           '  first byte {:8.4f}s  complete {:8.3f}s'.format(
+               n, received / 1048576, ttfb, total)
+
+
+def pending(n, chapters_per_index=20):
+    """n个未完成的目录文档,它们在全部章节生成后才完成"""
+    index = [XhtmlDoc('Text/index{}.xhtml'.format(i), '目录{}'.format(i),
+                      complete=False) for i in range(n)]
+    yield from index
+    for c in range(chapters_per_index):
+        for doc in index:
+            doc.append('<li><a href="{0}.xhtml">第{0}章 {1}</a></li>\n'.format(
+                c, '标题' * 20))
+        yield XhtmlDoc('Text/{}.xhtml'.format(c), '第{}章'.format(c))
+    for doc in index:
+        doc.complete = True
+
+
+def bench_pending(n=2000, memlimits=(None, 1 << 20)):
+    """大量未完成文档的内存峰值:不限制 vs 暂存到临时文件"""
+    home = tempfile.mkdtemp()
+    filename = os.path.join(home, 'pending.epub')
+    lines = ['{} pending index docs:'.format(n)]
+    for memlimit in memlimits:
+        f = EpubCreater(file=filename, showlog=False, memlimit=memlimit)
+        f.source.append(pending(n))
+        peak = peakmemory(f.write)
+        lines.append('  memlimit={!s:>8}: peak {:8.1f}KB  pending {:8.1f}KB'
+                     .format(memlimit, peak / 1024, f.pendingpeak / 1024))
+        os.remove(filename)
+    os.rmdir(home)
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import sys
+    names = sys.argv[1:] or [k[6:] for k in sorted(globals())
+                             if k.startswith('bench_')]
+    for name in names:
+        print(globals()['bench_' + name]())
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""测试与性能测试使用的本地小说网站
+它在一个后台线程中运行http.server,提供一本合成的小说:
+    /book/          目录页,列出每个章节的链接
+    /book/N.html    第N章,页面中有下一章的链接(nextpage="/book/N+1.html")
+unpredictable为True时,章节页的地址不是章节的序号而是一个无规律的编号,
+用于测试不能由前几页推测出后续地址的情况.
+它也可以作为http代理使用,这时不论请求的是哪个主机,都由它自己回答.
+它们可以直接用Iterators.iter_page/iter_url抓取:
+    iter_page(server.url, BookServer.hrefre, titlere=BookServer.titlere)
+    iter_url(server.root + '/{}/{}.html', 'book', 1,
+             titlere=BookServer.titlere)
+"""
+
+import gzip
+import hashlib
+import sys
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 客户端超时后断开了连接,不是服务器的错误
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # 响应头与内容分两次写入,不能等待ACK
+
+    def setup(self):
+        super().setup()
+        self.server.book.count('connections')
+
+    def do_GET(self):
+        book = self.server.book
+        if self.path.startswith('http://'):
+            # 作为http代理收到的请求,网站就是它自己
+            book.count('proxied')
+            self.path = '/' + self.path.split('/', 3)[3]
+        if not book.enter():
+            book.count('throttled')
+            self.send_response(429)
+            self.send_header('Retry-After', str(book.retryafter))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        try:
+            self.respond(book)
+        finally:
+            book.count('active', -1)
+
+    def respond(self, book):
+        body = book.page(self.path)
+        book.count('requests')
+        if book.latency:
+            time.sleep(book.latency)
+        if book.fail(self.path):
+            book.count('failed')
+            self.send_error(500)
+            return
+        if body is None:
+            self.send_error(404)
+            return
+        body = body.encode(book.charset)
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest()[:16])
+        if self.headers.get('If-None-Match') == etag:
+            book.count('notmodified')
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type',
+                         'text/html; charset=' + book.charset)
+        if book.gzip and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        book.count('sent', len(body))
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class BookServer(object):
+    """在本地运行的小说网站
+    chapters: 章节数
+    lines: 每章的段落数
+    latency: 每个请求的延迟(秒),模拟网络的往返时间
+    charset: 页面的编码,它在响应头中声明
+    gzip: 请求接受gzip时是否压缩响应的内容
+    maxactive: 同时处理的请求数的上限,超出的请求得到429(Retry-After为
+        retryafter秒),None为不限制
+    failures: {路径: 次数},这些页面的前若干次请求得到500,
+        用于模拟暂时性的故障,次数很大时页面一直不可用
+    unpredictable: 章节页的地址使用无规律的编号(见chapterid)
+    启动后url为目录页的地址,root为网站的根地址.
+    每个页面都带有ETag,以If-None-Match重新验证时回答304.
+    统计:requests为已经处理的请求数,connections为接受的连接数,
+        sent为发送的内容字节数,notmodified为回答304的次数,
+        throttled为回答429的次数,failed为回答500的次数,
+        proxied为作为http代理(请求行中是完整的url)收到的请求数
+    """
+    hrefre = r'<a href="(\d+\.html)">(.+?)</a>'  # 目录页中的章节链接
+    titlere = '<h1>(.+?)</h1>'  # 章节页中的标题
+
+    def __init__(self, chapters: int = 10, lines: int = 10,
+                 latency: float = 0, charset: str = 'utf-8',
+                 gzip: bool = True, maxactive: int = None,
+                 retryafter: float = 0.05, failures: dict = None,
+                 unpredictable: bool = False):
+        self.chapters = chapters
+        self.lines = lines
+        self.latency = latency
+        self.charset = charset
+        self.gzip = gzip
+        self.maxactive = maxactive
+        self.retryafter = retryafter
+        self.failures = dict(failures or {})
+        self.failed = 0
+        self.proxied = 0
+        self.unpredictable = unpredictable
+        self._numbers = {}  # 编号 -> 章节序号
+        self.active = 0
+        self.throttled = 0
+        self.requests = 0
+        self.connections = 0
+        self.sent = 0
+        self.notmodified = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def start(self):
+        """在后台线程中开始服务,返回self"""
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.book = self
+        threading.Thread(target=self._server.serve_forever,
+                         daemon=True).start()
+        return self
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    @property
+    def root(self) -> str:
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    @property
+    def url(self) -> str:
+        return self.root + '/book/'
+
+    def enter(self) -> bool:
+        """开始处理一个请求,超过maxactive时返回False"""
+        with self._lock:
+            if self.maxactive is not None and self.active >= self.maxactive:
+                return False
+            self.active += 1
+            return True
+
+    def fail(self, path: str) -> bool:
+        """这个请求是否应该失败,见failures"""
+        with self._lock:
+            if self.failures.get(path, 0) <= 0:
+                return False
+            self.failures[path] -= 1
+            return True
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def page(self, path: str):
+        """path对应的页面内容,没有这个页面时为None"""
+        if path == '/book/':
+            return self.index()
+        if path.startswith('/book/') and path.endswith('.html'):
+            try:
+                n = self.chapterno(int(path[6:-5]))
+            except ValueError:
+                return None
+            if n is not None and 1 <= n <= self.chapters:
+                return self.chapter(n)
+        return None
+
+    def chapterid(self, n: int) -> int:
+        """第n章的页面地址中的编号"""
+        if not self.unpredictable:
+            return n
+        digest = hashlib.sha1(str(n).encode('ascii')).hexdigest()
+        return int(digest[:12], 16) % 10 ** 9
+
+    def chapterno(self, cid: int):
+        """编号cid对应的章节序号,没有时为None"""
+        if not self.unpredictable:
+            return cid
+        with self._lock:
+            if len(self._numbers) != self.chapters:
+                self._numbers = {self.chapterid(n): n
+                                 for n in range(1, self.chapters + 1)}
+            return self._numbers.get(cid)
+
+    def index(self) -> str:
+        return '<html><head><title>书</title></head><body>\n{}</body></html>' \
+            .format(''.join('<a href="{}.html">第{}章 标题</a>\n'.format(
+                self.chapterid(n), n) for n in range(1, self.chapters + 1)))
+
+    def chapter(self, n: int) -> str:
+        lines = ''.join('&nbsp;&nbsp;&nbsp;&nbsp;第{}章的第{}段。<br/>\n'
+                        .format(n, i) for i in range(1, self.lines + 1))
+        nextpage = 'nextpage="/book/{}.html"'.format(self.chapterid(n + 1)) \
+            if n < self.chapters else ''
+        return '<html><head><title>第{0}章</title></head><body>\n' \
+               '<h1>第{0}章 标题</h1>\n{1}<div {2}></div></body></html>' \
+            .format(n, lines, nextpage)